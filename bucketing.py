@@ -0,0 +1,30 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+
+
+def make_buckets(lengths, max_tokens=16384, max_batch_size=512):
+    """
+    Groups texts of similar token length into batches.
+    Texts are visited from longest to shortest and a batch is closed once its padded size, the batch size times its longest text, would exceed `max_tokens`, or once it holds `max_batch_size` texts unless that is None.
+
+    Returns:
+        list of batches, each a list of indices into `lengths`.
+    """
+    order = np.argsort(-np.asarray(lengths), kind='stable').tolist()
+    buckets = []
+    batch, longest = [], 0
+    for i in order:
+        longest_i = max(longest, lengths[i])
+        if batch and (longest_i * (len(batch) + 1) > max_tokens or len(batch) == max_batch_size):
+            buckets.append(batch)
+            batch, longest_i = [], lengths[i]
+        batch.append(i)
+        longest = longest_i
+    if batch:
+        buckets.append(batch)
+    return buckets
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import bz2
+import argparse
+import ujson as json
+from tqdm.auto import tqdm
+from evaluation import iter_examples
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('fdata', nargs='+', help='.json.bz2 splits to convert, each is written next to the input as .jsonl.bz2')
+    args = parser.parse_args()
+
+    for fname in args.fdata:
+        assert fname.endswith('.json.bz2'), 'Expected a .json.bz2 file but got {}'.format(fname)
+        fout = fname[:-len('.json.bz2')] + '.jsonl.bz2'
+        print('Converting {} to {}'.format(fname, fout))
+        with bz2.open(fout, 'wt') as f:
+            for ex in tqdm(iter_examples(fname)):
+                f.write(json.dumps(ex) + '\n')
+
+
+if __name__ == '__main__':
+    main()
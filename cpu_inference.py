@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import time
+import torch
+import argparse
+import itertools
+import omegaconf
+import torch.multiprocessing as mp
+from torch.utils.data import IterableDataset
+from wrangl.learn import SupervisedModel
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+worker_model = None
+
+
+def iter_batches(dataset, batch_size):
+    if isinstance(dataset, IterableDataset) or not hasattr(dataset, '__getitem__'):
+        examples = iter(dataset)
+    else:
+        examples = (dataset[i] for i in range(len(dataset)))
+    while True:
+        batch = list(itertools.islice(examples, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def predict_batches(model, dataset, batch_size, callbacks=()):
+    """
+    Runs `model` over `dataset` in the current process.
+    """
+    pred = []
+    with torch.no_grad():
+        for batch in iter_batches(dataset, batch_size):
+            pred_batch = model.predict_step(batch, 0)
+            for callback in callbacks:
+                callback(batch, pred_batch)
+            pred.extend(pred_batch)
+    return pred
+
+
+def pin_worker(worker_id, num_threads):
+    torch.set_num_threads(num_threads)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= (worker_id + 1) * num_threads:
+            os.sched_setaffinity(0, cores[worker_id*num_threads:(worker_id+1)*num_threads])
+
+
+def init_worker(counter, model_name, cfg, state, num_threads):
+    global worker_model
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+    pin_worker(worker_id, num_threads)
+    # model classes are loaded from their files without being registered as modules, so they cannot be sent to workers and are loaded again here
+    Model = SupervisedModel.load_model_class(model_name, root_dir=ROOT_DIR)
+    # every weight is assigned from `state` below, so the language model is only built from its config instead of loading a private copy of the pretrained weights
+    Model.pretrained = False
+    worker_model = Model(cfg)
+    try:
+        # use the weights in shared memory instead of copying them into each worker
+        worker_model.load_state_dict(state, assign=True)
+    except TypeError:
+        worker_model.load_state_dict(state)
+    if cfg.get('quantize'):
+        # imported here because quantize.py depends on this module
+        from quantize import quantize_model
+        quantize_model(worker_model)
+    worker_model.configure_inference(cfg).eval()
+
+
+def predict_batch(batch):
+    with torch.no_grad():
+        return worker_model.predict_step(batch, 0)
+
+
+def run_inference_pool(Model, cfg, fcheckpoint, dataset, num_workers, num_threads=1, callbacks=()):
+    """
+    CPU alternative to `Model.run_inference` that spreads batches over `num_workers` processes, each using `num_threads` threads pinned to their own cores when there are enough.
+    The checkpoint is loaded once and its weights are shared by the workers.
+
+    Returns:
+        the predictions, in the order of `dataset`. Each of `callbacks` is called with every batch and its predictions, in order.
+    """
+    assert cfg.collate_fn == 'ignore', 'CPU inference requires batches of examples, use collate_fn=ignore'
+    model = Model.load_from_checkpoint(fcheckpoint, map_location='cpu')
+    state = {k: v.share_memory_() for k, v in model.state_dict().items()}
+    del model
+    ctx = mp.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    pred = []
+    with ctx.Pool(num_workers, initializer=init_worker, initargs=(counter, cfg.model, cfg, state, num_threads)) as pool:
+        # batches are sent a window at a time so that the processed examples of a large split are not all queued at once
+        batches = iter_batches(dataset, cfg.batch_size)
+        while True:
+            window = list(itertools.islice(batches, 4 * num_workers))
+            if not window:
+                break
+            for batch, pred_batch in zip(window, pool.map(predict_batch, window, chunksize=1)):
+                for callback in callbacks:
+                    callback(batch, pred_batch)
+                pred.extend(pred_batch)
+    return pred
+
+
+def benchmark(Model, cfg, fcheckpoint, dataset, num_workers, num_threads):
+    """
+    Reports the throughput of single process CPU inference using every core and of the worker pool for each number of workers, including the time to start the workers.
+    """
+    examples = list(dataset)
+    model = Model.load_from_checkpoint(fcheckpoint, map_location='cpu').configure_inference(cfg).eval()
+    torch.set_num_threads(os.cpu_count())
+    start = time.time()
+    expect = predict_batches(model, examples, cfg.batch_size)
+    results = [dict(method='single', workers=1, threads=os.cpu_count(), examples_per_sec=len(examples) / (time.time() - start), same_pred=True)]
+    del model
+    for n in num_workers:
+        start = time.time()
+        pred = run_inference_pool(Model, cfg, fcheckpoint, examples, n, num_threads=num_threads)
+        results.append(dict(method='pool', workers=n, threads=num_threads, examples_per_sec=len(examples) / (time.time() - start), same_pred=pred == expect))
+    return results
+
+
+if __name__ == '__main__':
+    from train_baselines import load_eval_split
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dsave', help='save folder of experiment')
+    parser.add_argument('--fsave', default='last.ckpt', help='checkpoint file')
+    parser.add_argument('--fdata', default='dataset_construction/evidence/closed/top_5.dev.json.bz2', help='data file to benchmark on')
+    parser.add_argument('--num_examples', default=200, type=int)
+    parser.add_argument('--num_workers', nargs='+', default=[1, 2, 4, 8], type=int)
+    parser.add_argument('--num_threads', default=1, type=int, help='threads per worker')
+    args = parser.parse_args()
+
+    cfg = omegaconf.OmegaConf.load(os.path.join(args.dsave, 'config.yaml'))
+    Model = SupervisedModel.load_model_class(cfg.model, root_dir=ROOT_DIR)
+    _, dataset = load_eval_split(args.fdata, Model)
+    examples = next(iter_batches(dataset, args.num_examples), [])
+    for r in benchmark(Model, cfg, os.path.join(args.dsave, args.fsave), examples, args.num_workers, args.num_threads):
+        print(r)
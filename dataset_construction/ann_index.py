@@ -0,0 +1,236 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import bz2
+import time
+import argparse
+import numpy as np
+import ujson as json
+import tqdm
+from sentence_transformers import SentenceTransformer
+from sentence_store import SentenceEmbeddingStore
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def kmeans(x, k, iters=20, seed=0, spherical=True):
+    """
+    Lloyd's k-means. With `spherical`, points are assigned by inner product and centroids are renormalized, which suits normalized embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=len(x) < k)].copy()
+    for _ in range(iters):
+        if spherical:
+            assign = (x @ centroids.T).argmax(1)
+        else:
+            assign = ((x ** 2).sum(1, keepdims=True) - 2 * x @ centroids.T + (centroids ** 2).sum(1)).argmin(1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        # reseed empty clusters with random points
+        sums[empty] = x[rng.choice(len(x), size=empty.sum())]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index for maximum inner product search over normalized embeddings, so scores are cosine similarities.
+    Vectors are assigned to the nearest of `nlist` centroids and stored grouped by list.
+    Each list stores either float16 vectors or, with product quantization, `pq_m` one byte codes of the residual to the list centroid.
+    A saved index is a directory of `.npy` arrays that can be memory-mapped.
+    """
+
+    def __init__(self, centroids, list_indptr, list_ids, vectors=None, codes=None, codebooks=None):
+        self.centroids = centroids
+        self.list_indptr = list_indptr
+        self.list_ids = list_ids
+        self.vectors = vectors
+        self.codes = codes
+        self.codebooks = codebooks
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, nlist, pq_m=None, train_size=200000, iters=20, chunk_size=100000, seed=0):
+        """
+        Builds the index.
+
+        Args:
+            embeddings: (N, d) matrix, for instance the memory-mapped `SentenceEmbeddingStore.embeddings`.
+            nlist: number of inverted lists.
+            pq_m: number of product quantization sub-spaces, which must divide d. If not given, vectors are stored in float16.
+            train_size: number of vectors sampled to train the centroids and codebooks.
+            chunk_size: number of vectors assigned at a time.
+        """
+        rng = np.random.default_rng(seed)
+        num, dim = embeddings.shape
+        sample = normalize(embeddings[np.sort(rng.choice(num, size=min(num, train_size), replace=False))])
+        print('training {} centroids'.format(nlist))
+        centroids = kmeans(sample, nlist, iters=iters, seed=seed)
+
+        codebooks = None
+        if pq_m:
+            assert dim % pq_m == 0, 'pq_m={} must divide the embedding dimension {}'.format(pq_m, dim)
+            residuals = sample - centroids[(sample @ centroids.T).argmax(1)]
+            sub = residuals.reshape(len(sample), pq_m, dim // pq_m)
+            codebooks = np.stack([kmeans(sub[:, j], 256, iters=iters, seed=seed, spherical=False) for j in tqdm.trange(pq_m, desc='training pq codebooks')])
+
+        assign = np.empty(num, dtype=np.int64)
+        for start in tqdm.trange(0, num, chunk_size, desc='assigning lists'):
+            assign[start:start+chunk_size] = (normalize(embeddings[start:start+chunk_size]) @ centroids.T).argmax(1)
+        list_ids = np.argsort(assign, kind='stable')
+        list_indptr = np.zeros(nlist + 1, dtype=np.int64)
+        list_indptr[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+
+        vectors = codes = None
+        if pq_m:
+            codes = np.empty((num, pq_m), dtype=np.uint8)
+        else:
+            vectors = np.empty((num, dim), dtype=np.float16)
+        for start in tqdm.trange(0, num, chunk_size, desc='encoding lists'):
+            ids = list_ids[start:start+chunk_size]
+            x = normalize(embeddings[np.sort(ids)])[np.argsort(np.argsort(ids))]
+            if pq_m:
+                sub = (x - centroids[assign[ids]]).reshape(len(ids), pq_m, dim // pq_m)
+                for j in range(pq_m):
+                    # nearest code word by squared distance, dropping the constant norm of the residual
+                    codes[start:start+len(ids), j] = ((codebooks[j] ** 2).sum(1) - 2 * sub[:, j] @ codebooks[j].T).argmin(1)
+            else:
+                vectors[start:start+len(ids)] = x
+        return cls(centroids, list_indptr, list_ids, vectors=vectors, codes=codes, codebooks=codebooks)
+
+    def save(self, dout):
+        os.makedirs(dout, exist_ok=True)
+        for k in ['centroids', 'list_indptr', 'list_ids', 'vectors', 'codes', 'codebooks']:
+            if getattr(self, k) is not None:
+                np.save(os.path.join(dout, '{}.npy'.format(k)), getattr(self, k))
+
+    @classmethod
+    def load(cls, din, mmap=True):
+        arrays = {}
+        for k in ['centroids', 'list_indptr', 'list_ids', 'vectors', 'codes', 'codebooks']:
+            fname = os.path.join(din, '{}.npy'.format(k))
+            if os.path.isfile(fname):
+                arrays[k] = np.load(fname, mmap_mode='r' if mmap else None)
+        return cls(**arrays)
+
+    def search(self, queries, top_k, nprobe=8):
+        """
+        Finds the approximate `top_k` vectors for each query among the `nprobe` lists whose centroids are closest to the query.
+
+        Args:
+            queries: (nq, d) query embeddings, normalized internally.
+
+        Returns:
+            (nq, top_k) row ids into the indexed embeddings, padded with -1, and the corresponding (approximate) cosine scores.
+        """
+        queries = normalize(queries)
+        coarse = queries @ self.centroids.T
+        nprobe = min(nprobe, self.nlist)
+        probe = np.argpartition(-coarse, nprobe-1, axis=1)[:, :nprobe]
+        ids = np.full((len(queries), top_k), -1, dtype=np.int64)
+        scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        for qi, q in enumerate(queries):
+            if self.codes is not None:
+                # inner products between each query sub-vector and each code word
+                m = len(self.codebooks)
+                table = np.einsum('jkd,jd->jk', self.codebooks, q.reshape(m, -1))
+            cand_ids, cand_scores = [], []
+            for l in probe[qi]:
+                start, end = self.list_indptr[l], self.list_indptr[l+1]
+                if start == end:
+                    continue
+                if self.codes is not None:
+                    s = coarse[qi, l] + table[np.arange(m), self.codes[start:end]].sum(1)
+                else:
+                    s = self.vectors[start:end].astype(np.float32) @ q
+                cand_ids.append(self.list_ids[start:end])
+                cand_scores.append(s)
+            if not cand_ids:
+                continue
+            cand_ids, cand_scores = np.concatenate(cand_ids), np.concatenate(cand_scores)
+            if len(cand_ids) > top_k:
+                keep = np.argpartition(-cand_scores, top_k-1)[:top_k]
+                cand_ids, cand_scores = cand_ids[keep], cand_scores[keep]
+            order = np.argsort(-cand_scores, kind='stable')
+            ids[qi, :len(order)] = cand_ids[order]
+            scores[qi, :len(order)] = cand_scores[order]
+        return ids, scores
+
+
+def exact_search(embeddings, queries, top_k, chunk_size=100000):
+    """
+    Brute force cosine search, used as the reference for `IVFIndex.search`.
+    """
+    queries = normalize(queries)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        s = queries @ normalize(embeddings[start:start+chunk_size]).T
+        cand_ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, start+s.shape[1]), s.shape)], axis=1)
+        cand_scores = np.concatenate([best_scores, s], axis=1)
+        keep = np.argsort(-cand_scores, axis=1, kind='stable')[:, :top_k]
+        best_ids = np.take_along_axis(cand_ids, keep, 1)
+        best_scores = np.take_along_axis(cand_scores, keep, 1)
+    return best_ids, best_scores
+
+
+def benchmark(index, embeddings, queries, top_k, nprobes):
+    """
+    Reports recall@k of `index` against exact search and the per-query latency of both.
+    """
+    start = time.time()
+    exact_ids, _ = exact_search(embeddings, queries, top_k)
+    results = [dict(method='exact', nprobe=None, recall=1.0, ms_per_query=1000 * (time.time() - start) / len(queries))]
+    for nprobe in nprobes:
+        start = time.time()
+        ids, _ = index.search(queries, top_k, nprobe=nprobe)
+        elapsed = time.time() - start
+        recall = np.mean([len(set(a.tolist()) & set(e.tolist())) / len(e) for a, e in zip(ids, exact_ids)])
+        results.append(dict(method='ivf' if index.codes is None else 'ivfpq', nprobe=nprobe, recall=float(recall), ms_per_query=1000 * elapsed / len(queries)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('--fsent_emb', help='sentence embeddings built by sentence_store.py', default='evidence/sent_emb')
+    parser.add_argument('--dindex', help='index directory', default='evidence/sent_ann')
+    parser.add_argument('--nlist', default=4096, type=int)
+    parser.add_argument('--pq_m', default=None, type=int, help='number of product quantization sub-spaces, store float16 vectors if not given')
+    parser.add_argument('--train_size', default=200000, type=int)
+    parser.add_argument('--fdata', help='questions to benchmark with', default='evidence/gold/dev.json.bz2')
+    parser.add_argument('--dpretrained_question_encoder', default='./pretrained/facebook-dpr-question_encoder-multiset-base')
+    parser.add_argument('--num_queries', default=1000, type=int)
+    parser.add_argument('--top_k', default=100, type=int)
+    parser.add_argument('--nprobe', nargs='+', default=[1, 4, 16, 64], type=int)
+    parser.add_argument('--device', default='cuda')
+    args = parser.parse_args()
+
+    store = SentenceEmbeddingStore.load(args.fsent_emb)
+    if args.command == 'build':
+        index = IVFIndex.build(store.embeddings, args.nlist, pq_m=args.pq_m, train_size=args.train_size)
+        print('saving index to {}'.format(args.dindex))
+        index.save(args.dindex)
+    else:
+        index = IVFIndex.load(args.dindex)
+        with bz2.open(args.fdata, 'rt') as f:
+            questions = sorted({ex['question'] for ex in json.load(f)})[:args.num_queries]
+        encoder = SentenceTransformer(args.dpretrained_question_encoder, device=args.device)
+        queries = encoder.encode(questions, show_progress_bar=False, convert_to_numpy=True)
+        for r in benchmark(index, store.embeddings, queries, args.top_k, args.nprobe):
+            print(json.dumps(r))
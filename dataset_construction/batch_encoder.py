@@ -0,0 +1,36 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import sys
+import numpy as np
+from collections import OrderedDict
+
+# the bucketing is shared with the models, from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bucketing import make_buckets  # noqa: E402
+
+
+def token_lengths(encoder, texts):
+    tokenized = encoder.tokenizer(texts, add_special_tokens=True, truncation=True, max_length=encoder.max_seq_length)
+    return [len(ids) for ids in tokenized['input_ids']]
+
+
+def encode_bucketed(encoder, texts, max_tokens=16384, max_batch_size=512):
+    """
+    Encodes `texts` with a `SentenceTransformer` in batches bucketed by token length.
+    Duplicate texts are encoded once.
+
+    Returns:
+        float32 array of embeddings, one row per text in the order of `texts`.
+    """
+    unique = list(OrderedDict.fromkeys(texts))
+    out = np.zeros((len(unique), encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+    if unique:
+        for batch in make_buckets(token_lengths(encoder, unique), max_tokens=max_tokens, max_batch_size=max_batch_size):
+            out[batch] = encoder.encode([unique[i] for i in batch], batch_size=len(batch), show_progress_bar=False, convert_to_numpy=True)
+    index = {t: i for i, t in enumerate(unique)}
+    return out[[index[t] for t in texts]]
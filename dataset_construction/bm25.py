@@ -0,0 +1,327 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import bz2
+import bisect
+import math
+import string
+import argparse
+import pickle
+import numpy as np
+import scipy.sparse as sp
+import ujson as json
+from tqdm.auto import tqdm
+from stop_words import STOP_WORDS
+
+
+# We lower case our text and remove stop-words from indexing
+def bm25_tokenizer(text):
+    tokenized_doc = []
+    for token in text.lower().split():
+        token = token.strip(string.punctuation)
+
+        if len(token) > 0 and token not in STOP_WORDS:
+            tokenized_doc.append(token)
+    return tokenized_doc
+
+
+class Vocab:
+    """
+    Sorted vocabulary stored as one UTF-8 byte buffer and term offsets, so that it can be memory-mapped.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_terms(cls, terms):
+        encoded = [t.encode('utf-8') for t in sorted(terms)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t) for t in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def index(self, term):
+        # UTF-8 byte order is the same as code point order, so the sorted terms are also sorted as bytes
+        key = term.encode('utf-8')
+        i = bisect.bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return None
+
+
+class BM25Index:
+    """
+    Okapi BM25 over CSR posting lists.
+    Row `t` of the CSR matrix holds the documents containing term `t` and their term frequencies.
+    Scores are computed the same way as `rank_bm25.BM25Okapi.get_scores`, but only over the postings of the query terms.
+    A saved index is a directory of `.npy` arrays that can be memory-mapped, so that many workers share one copy through the page cache.
+    """
+
+    ARRAYS = ['vocab_blob', 'vocab_offsets', 'indptr', 'doc_ids', 'tfs', 'idf', 'doc_norm']
+
+    def __init__(self, vocab_blob, vocab_offsets, indptr, doc_ids, tfs, idf, doc_norm, k1=1.5, b=0.75):
+        self.vocab = Vocab(vocab_blob, vocab_offsets)
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.idf = idf
+        self.doc_norm = doc_norm
+        self.k1 = k1
+        self.b = b
+
+    @property
+    def vocab_blob(self):
+        return self.vocab.blob
+
+    @property
+    def vocab_offsets(self):
+        return self.vocab.offsets
+
+    @property
+    def corpus_size(self):
+        return len(self.doc_norm)
+
+    @classmethod
+    def compute_doc_norm(cls, doc_len, avgdl, k1, b):
+        # same operation order as BM25Okapi so that scores match bit for bit
+        return k1 * (1 - b + b * np.asarray(doc_len) / avgdl)
+
+    @classmethod
+    def from_doc_freqs(cls, doc_freqs, idf, avgdl, k1=1.5, b=0.75):
+        """
+        Builds the index from per-document term frequencies and term idfs.
+
+        Args:
+            doc_freqs: list of `{term: frequency}` dictionaries, one per document.
+            idf: dictionary of `{term: idf}`.
+            avgdl: average document length.
+        """
+        vocab = sorted(idf.keys())
+        term2id = {t: i for i, t in enumerate(vocab)}
+        encoded = Vocab.from_terms(vocab)
+        postings = [[] for _ in vocab]
+        doc_len = np.zeros(len(doc_freqs), dtype=np.int64)
+        for d, freqs in enumerate(tqdm(doc_freqs, desc='building postings')):
+            doc_len[d] = sum(freqs.values())
+            for t, f in freqs.items():
+                postings[term2id[t]].append((d, f))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(p) for p in postings])
+        doc_ids = np.empty(indptr[-1], dtype=np.int32)
+        tfs = np.empty(indptr[-1], dtype=np.int32)
+        for i, p in enumerate(postings):
+            if p:
+                doc_ids[indptr[i]:indptr[i+1]], tfs[indptr[i]:indptr[i+1]] = zip(*p)
+        return cls(
+            vocab_blob=encoded.blob,
+            vocab_offsets=encoded.offsets,
+            indptr=indptr,
+            doc_ids=doc_ids,
+            tfs=tfs,
+            idf=np.array([idf[t] for t in vocab], dtype=np.float64),
+            doc_norm=cls.compute_doc_norm(doc_len, avgdl, k1, b),
+            k1=k1,
+            b=b,
+        )
+
+    @classmethod
+    def from_okapi(cls, bm25):
+        """
+        Converts a fitted `rank_bm25.BM25Okapi` object.
+        """
+        return cls.from_doc_freqs(bm25.doc_freqs, bm25.idf, bm25.avgdl, k1=bm25.k1, b=bm25.b)
+
+    @classmethod
+    def from_corpus(cls, tokenized_corpus, k1=1.5, b=0.75, epsilon=0.25):
+        """
+        Builds the index from tokenized documents, computing idf as `rank_bm25.BM25Okapi` does.
+        """
+        doc_freqs = []
+        nd = {}
+        num_tokens = 0
+        for doc in tokenized_corpus:
+            num_tokens += len(doc)
+            freqs = {}
+            for t in doc:
+                freqs[t] = freqs.get(t, 0) + 1
+            doc_freqs.append(freqs)
+            for t in freqs:
+                nd[t] = nd.get(t, 0) + 1
+        corpus_size = len(doc_freqs)
+        idf = {}
+        idf_sum = 0
+        negative_idfs = []
+        for t, freq in nd.items():
+            idf[t] = math.log(corpus_size - freq + 0.5) - math.log(freq + 0.5)
+            idf_sum += idf[t]
+            if idf[t] < 0:
+                negative_idfs.append(t)
+        eps = epsilon * idf_sum / len(idf)
+        for t in negative_idfs:
+            idf[t] = eps
+        return cls.from_doc_freqs(doc_freqs, idf, num_tokens / corpus_size, k1=k1, b=b)
+
+    def save(self, dout):
+        os.makedirs(dout, exist_ok=True)
+        for k in self.ARRAYS:
+            np.save(os.path.join(dout, '{}.npy'.format(k)), getattr(self, k))
+        with open(os.path.join(dout, 'meta.json'), 'wt') as f:
+            json.dump(dict(k1=self.k1, b=self.b), f)
+
+    @classmethod
+    def load(cls, din, mmap=True):
+        """
+        Loads a saved index.
+
+        Args:
+            din: index directory.
+            mmap: memory-map the arrays read-only instead of reading them into private memory.
+        """
+        with open(os.path.join(din, 'meta.json'), 'rt') as f:
+            meta = json.load(f)
+        arrays = {k: np.load(os.path.join(din, '{}.npy'.format(k)), mmap_mode='r' if mmap else None) for k in cls.ARRAYS}
+        return cls(**meta, **arrays)
+
+    def get_postings(self, term_id):
+        start, end = self.indptr[term_id], self.indptr[term_id+1]
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+    def get_sparse_scores(self, query):
+        """
+        Scores the documents that contain at least one query term.
+
+        Args:
+            query: list of query tokens. Repeated tokens contribute once per occurrence.
+
+        Returns:
+            the ids of the matched documents in increasing order, and their scores.
+        """
+        docs, contribs = [], []
+        for t in query:
+            term_id = self.vocab.index(t)
+            if term_id is None or not self.idf[term_id]:
+                continue
+            doc_ids, tfs = self.get_postings(term_id)
+            docs.append(doc_ids)
+            contribs.append(self.idf[term_id] * (tfs * (self.k1 + 1) / (tfs + self.doc_norm[doc_ids])))
+        if not docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.zeros(len(docs), dtype=np.float64)
+        # add.at accumulates in query term order, matching the dense summation of BM25Okapi
+        np.add.at(scores, inverse, np.concatenate(contribs))
+        return docs, scores
+
+    def get_scores(self, query):
+        """
+        Dense scores over the whole corpus, equivalent to `BM25Okapi.get_scores`.
+        """
+        docs, scores = self.get_sparse_scores(query)
+        dense = np.zeros(self.corpus_size, dtype=np.float64)
+        dense[docs] = scores
+        return dense
+
+    def select_top_k(self, docs, scores, top_k):
+        """
+        Returns the `top_k` highest scoring documents and their scores, sorted by decreasing score.
+        Ties are broken by document index.
+        If fewer than `top_k` documents match, the remainder is filled with the lowest indexed unmatched documents, which score 0.
+
+        Args:
+            docs: ids of the matched documents.
+            scores: corresponding scores.
+        """
+        if len(docs) > top_k:
+            keep = np.argpartition(-scores, top_k-1)[:top_k]
+            # include everything tied with the k-th best score so ties are broken deterministically
+            keep = np.flatnonzero(scores >= scores[keep].min())
+            docs, scores = docs[keep], scores[keep]
+        order = np.lexsort((docs, -scores))[:top_k]
+        docs, scores = docs[order].tolist(), scores[order].tolist()
+        if len(docs) < top_k:
+            matched = set(docs)
+            d = 0
+            while len(docs) < min(top_k, self.corpus_size):
+                if d not in matched:
+                    docs.append(d)
+                    scores.append(0.)
+                d += 1
+        return docs, scores
+
+    def top_k(self, query, top_k):
+        """
+        Returns the `top_k` documents for one tokenized query, see `select_top_k`.
+        """
+        docs, scores = self.get_sparse_scores(query)
+        return self.select_top_k(docs, scores, top_k)
+
+    def top_k_batch(self, queries, top_k):
+        """
+        Returns the `top_k` documents for each of a block of tokenized queries.
+        The block is scored with one sparse product between the query-term count matrix and the term-document weight matrix restricted to the terms of the block.
+        Scores may differ from `top_k` in the last bits because the per-term weights are summed in a different order.
+        """
+        term_cols = {}
+        rows, cols = [], []
+        for i, query in enumerate(queries):
+            for t in query:
+                term_id = self.vocab.index(t)
+                if term_id is None or not self.idf[term_id]:
+                    continue
+                rows.append(i)
+                cols.append(term_cols.setdefault(term_id, len(term_cols)))
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        if not term_cols:
+            return [self.select_top_k(*empty, top_k) for _ in queries]
+        # duplicate (row, col) entries are summed, so repeated query terms are counted
+        query_term = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(queries), len(term_cols)))
+
+        term_ids = np.array(list(term_cols.keys()), dtype=np.int64)
+        starts, ends = self.indptr[term_ids], self.indptr[term_ids+1]
+        lengths = ends - starts
+        indptr = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        doc_ids, tfs = self.doc_ids[positions], self.tfs[positions]
+        weights = np.repeat(self.idf[term_ids], lengths) * (tfs * (self.k1 + 1) / (tfs + self.doc_norm[doc_ids]))
+        term_doc = sp.csr_matrix((weights, doc_ids, indptr), shape=(len(term_ids), self.corpus_size))
+
+        scores = query_term @ term_doc
+        out = []
+        for i in range(len(queries)):
+            start, end = scores.indptr[i], scores.indptr[i+1]
+            out.append(self.select_top_k(scores.indices[start:end].astype(np.int64), scores.data[start:end], top_k))
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--fdocs', help='sorted document corpus', default='evidence/sorted_docs.json.bz2')
+    parser.add_argument('--from_pickle', help='convert an existing pickled BM25Okapi index instead of indexing fdocs')
+    parser.add_argument('--dout', help='output index directory', default='evidence/bm25_index')
+    args = parser.parse_args()
+
+    if args.from_pickle:
+        print('loading bm25 from {}'.format(args.from_pickle))
+        with open(args.from_pickle, 'rb') as f:
+            index = BM25Index.from_okapi(pickle.load(f))
+    else:
+        print('loading docs')
+        with bz2.open(args.fdocs, 'rt') as f:
+            docs = json.load(f)
+        tokenized_corpus = [bm25_tokenizer(text) for i, text in tqdm(docs, desc='tokenizing docs')]
+        index = BM25Index.from_corpus(tokenized_corpus)
+    print('saving bm25 index to {}'.format(args.dout))
+    index.save(args.dout)
@@ -5,54 +5,69 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
-import string
+import multiprocessing
 import os
 from tqdm.auto import tqdm
-import pickle
 import bz2
 import ray
-import numpy as np
 import ujson as json
-from stop_words import STOP_WORDS
+from bm25 import BM25Index, bm25_tokenizer
 from wrangl.data import IterableDataset, Processor
 
 
-# We lower case our text and remove stop-words from indexing
-def bm25_tokenizer(text):
-    tokenized_doc = []
-    for token in text.lower().split():
-        token = token.strip(string.punctuation)
-
-        if len(token) > 0 and token not in STOP_WORDS:
-            tokenized_doc.append(token)
-    return tokenized_doc
-
-
 @ray.remote
 class MyProcessor(Processor):
 
     def __init__(self, fbm25, top_k):
-        with open(fbm25, 'rb') as f:
-            self.bm25 = pickle.load(f)
+        self.bm25 = BM25Index.load(fbm25)
         self.top_k = top_k
 
     def process(self, query):
-        bm25_scores = self.bm25.get_scores(bm25_tokenizer(query))
-        top_k_inds = np.argpartition(bm25_scores, -self.top_k)[-self.top_k:].tolist()
-        return query, top_k_inds, [bm25_scores[i] for i in top_k_inds]
+        top_k_inds, top_k_scores = self.bm25.top_k(bm25_tokenizer(query), self.top_k)
+        return query, top_k_inds, top_k_scores
+
+
+def init_batch_worker(fbm25, top_k):
+    global batch_bm25, batch_top_k
+    batch_bm25 = BM25Index.load(fbm25)
+    batch_top_k = top_k
+
+
+def process_batch(queries):
+    results = batch_bm25.top_k_batch([bm25_tokenizer(q) for q in queries], batch_top_k)
+    return [(q, top_k_inds, top_k_scores) for q, (top_k_inds, top_k_scores) in zip(queries, results)]
+
+
+def search_batched(pool, queries, batch_size):
+    blocks = [queries[i:i+batch_size] for i in range(0, len(queries), batch_size)]
+    for results in pool.imap(process_batch, blocks):
+        yield from results
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--doc_index', default='evidence/bm25_index.pkl')
+    parser.add_argument('--doc_index', default='evidence/bm25_index', help='index directory built by bm25.py')
     parser.add_argument('--data_dir', default='evidence/gold')
     parser.add_argument('--data_out', default='evidence')
     parser.add_argument('--top_k', default=5, type=int)
     parser.add_argument('--num_workers', default=24, type=int)
+    parser.add_argument('--batch_size', default=0, type=int, help='if set, score blocks of this many queries with sparse matrix products in a local process pool instead of using ray')
     args = parser.parse_args()
+    if not os.path.isdir(args.doc_index):
+        parser.error('missing bm25 index directory {}, build it with bm25.py or convert a pickled index with bm25.py --from_pickle'.format(args.doc_index))
 
+    # each worker memory-maps the same index files, so the workers share one physical copy through the page cache
     print('loading bm25')
-    pool = ray.util.ActorPool([MyProcessor.remote(args.doc_index, args.top_k) for _ in range(args.num_workers)])
+    if args.batch_size:
+        pool = multiprocessing.Pool(args.num_workers, initializer=init_batch_worker, initargs=(args.doc_index, args.top_k))
+
+        def search(queries):
+            return search_batched(pool, queries, args.batch_size)
+    else:
+        pool = ray.util.ActorPool([MyProcessor.remote(args.doc_index, args.top_k) for _ in range(args.num_workers)])
+
+        def search(queries):
+            return IterableDataset(queries, pool, cache_size=args.num_workers*10, shuffle=True, timeout=1200)
 
     print('computing entity and question set')
     entities = set()
@@ -70,7 +85,7 @@ if __name__ == '__main__':
     entities = sorted(list(entities))
     questions = sorted(list(questions))
 
-    loader = IterableDataset(entities, pool, cache_size=args.num_workers*10, shuffle=True, timeout=1200)
+    loader = search(entities)
 
     with bz2.open(os.path.join(args.data_out, 'bm25_docs_by_entity.jsonl.bz2'), 'wt') as f:
         for ent, top_k_inds, top_k_scores in tqdm(loader, total=len(entities), desc='bm25 searching entities'):
@@ -80,7 +95,7 @@ if __name__ == '__main__':
             x = json.dumps([ent, lst])
             f.write(x + '\n')
 
-    loader = IterableDataset(questions, pool, cache_size=args.num_workers*10, shuffle=True, timeout=1200)
+    loader = search(questions)
 
     with bz2.open(os.path.join(args.data_out, 'bm25_docs_by_question.jsonl.bz2'), 'wt') as f:
         for que, top_k_inds, top_k_scores in tqdm(loader, total=len(questions), desc='bm25 searching questions'):
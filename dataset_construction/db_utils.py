@@ -4,23 +4,44 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import time
 import tqdm
+import itertools
+import contextlib
 import ujson as json
 
 
-def make_tables(c, tables):
+# columns of the UNIQUE constraints of the tables of `make_tables`, which bulk loads create as indexes after inserting instead
+UNIQUE_COLUMNS = {
+    'ents': ['uri'],
+    'props': ['uri'],
+    'docs': ['uri'],
+    'trips': ['subj_id', 'obj_id', 'prop_id'],
+    'evidence': ['trip_id', 'doc_id', 'start', 'end'],
+}
+
+
+def unique_constraint(table, deferred):
+    return '' if deferred else ', UNIQUE({})'.format(', '.join(UNIQUE_COLUMNS[table]))
+
+
+def make_tables(c, tables, deferred=False):
+    """
+    Creates `tables`, dropping existing ones.
+    With `deferred`, the tables are created without their UNIQUE constraints, which `create_indexes` adds once they are loaded.
+    """
     # drop existing tables
     for t in tables:
         c.execute('DROP TABLE IF EXISTS {}'.format(t))
 
     if 'ents' in tables:
-        c.execute('CREATE TABLE ents(id INTEGER PRIMARY KEY, uri TEXT, text TEXT, aliases JSON, desc TEXT, wiki_title TEXT, UNIQUE(uri))')
+        c.execute('CREATE TABLE ents(id INTEGER PRIMARY KEY, uri TEXT, text TEXT, aliases JSON, desc TEXT, wiki_title TEXT{})'.format(unique_constraint('ents', deferred)))
 
     if 'props' in tables:
-        c.execute('CREATE TABLE props(id INTEGER PRIMARY KEY, uri TEXT, text TEXT, aliases JSON, desc TEXT, UNIQUE(uri))')
+        c.execute('CREATE TABLE props(id INTEGER PRIMARY KEY, uri TEXT, text TEXT, aliases JSON, desc TEXT{})'.format(unique_constraint('props', deferred)))
 
     if 'docs' in tables:
-        c.execute('CREATE TABLE docs(id INTEGER PRIMARY KEY, uri TEXT, title TEXT, text TEXT, UNIQUE(uri))')
+        c.execute('CREATE TABLE docs(id INTEGER PRIMARY KEY, uri TEXT, title TEXT, text TEXT{})'.format(unique_constraint('docs', deferred)))
 
     if 'trips' in tables:
         c.execute("""
@@ -28,12 +49,11 @@ def make_tables(c, tables):
                 id INTEGER PRIMARY KEY,
                 subj_id INTEGER NOT NULL,
                 obj_id INTEGER NOT NULL,
-                prop_id INTEGER NOT NULL,
-                UNIQUE(subj_id, obj_id, prop_id),
+                prop_id INTEGER NOT NULL{}
                 FOREIGN KEY (subj_id) REFERENCES ents(id),
                 FOREIGN KEY (obj_id) REFERENCES ents(id),
                 FOREIGN KEY (prop_id) REFERENCES props(id)
-        )""")
+        )""".format(unique_constraint('trips', deferred) + ','))
 
     if 'evidence' in tables:
         c.execute("""
@@ -42,11 +62,10 @@ def make_tables(c, tables):
                 trip_id INTEGER NOT NULL,
                 doc_id INTEGER NOT NULL,
                 start INTEGER NOT NULL,
-                end INTEGER NOT NULL,
-                UNIQUE(trip_id, doc_id, start, end),
+                end INTEGER NOT NULL{}
                 FOREIGN KEY (trip_id) REFERENCES trips(id),
                 FOREIGN KEY (doc_id) REFERENCES docs(id)
-        )""")
+        )""".format(unique_constraint('evidence', deferred) + ','))
 
 
 def make_annotation_tables(c, tables, drop_existing=False):
@@ -105,3 +124,86 @@ def batch_insert(db, table, items, batch_size=100000):
             raise e
         finally:
             c.close()
+
+
+def has_index(db, table, cols):
+    for _, name, *_ in db.execute('PRAGMA index_list({})'.format(table)).fetchall():
+        if [r[2] for r in db.execute('PRAGMA index_info({})'.format(name))] == cols:
+            return True
+    return False
+
+
+def create_indexes(db, tables):
+    """
+    Adds the UNIQUE constraints that `make_tables` deferred as unique indexes, which also serve lookups by their leading columns, e.g. evidence by `trip_id`.
+    Building an index once over a loaded table is much faster than maintaining it on every insert.
+    Tables created with their constraints already have these indexes and are skipped.
+    """
+    for t in tables:
+        if t in UNIQUE_COLUMNS and not has_index(db, t, UNIQUE_COLUMNS[t]):
+            start = time.time()
+            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS {}_unique ON {}({})'.format(t, t, ', '.join(UNIQUE_COLUMNS[t])))
+            db.commit()
+            print('indexed {} in {:.1f}s'.format(t, time.time() - start))
+
+
+@contextlib.contextmanager
+def load_pragmas(db, journal_mode='MEMORY', synchronous='OFF', cache_size_mb=1024):
+    """
+    Trades durability for speed while bulk loading: a crash during the load can corrupt the database, which is then rebuilt from scratch.
+    The previous settings are restored afterwards.
+    """
+    db.commit()
+    before = {k: db.execute('PRAGMA {}'.format(k)).fetchone()[0] for k in ['journal_mode', 'synchronous', 'cache_size', 'foreign_keys']}
+    db.execute('PRAGMA journal_mode={}'.format(journal_mode))
+    db.execute('PRAGMA synchronous={}'.format(synchronous))
+    db.execute('PRAGMA cache_size={}'.format(-1024 * cache_size_mb))
+    db.execute('PRAGMA foreign_keys=OFF')
+    try:
+        yield db
+    finally:
+        db.commit()
+        for k, v in before.items():
+            db.execute('PRAGMA {}={}'.format(k, v))
+
+
+def bulk_insert(db, table, rows, batch_size=100000, total=None, **pragmas):
+    """
+    Streaming alternative to `batch_insert` for large tables.
+    `rows` can be any iterable, including a generator, and JSON columns are encoded lazily, so that only one batch is held in memory.
+    Use with tables created by `make_tables(..., deferred=True)` and call `create_indexes` once every table is loaded.
+
+    Returns:
+        the number of rows inserted.
+    """
+    cols = db.execute('PRAGMA table_info({})'.format(table)).fetchall()
+    json_cols_idx = {i for i, name, dtype, _, _, _ in cols if dtype == 'JSON'}
+    if json_cols_idx:
+        rows = ([json.dumps(c) if ci in json_cols_idx else c for ci, c in enumerate(r)] for r in rows)
+    rows = iter(rows)
+    q = 'INSERT INTO {} VALUES({})'.format(table, ', '.join(['?'] * len(cols)))
+
+    num_rows = 0
+    start = time.time()
+    bar = tqdm.tqdm(total=total, desc='insert {}'.format(table), unit='rows')
+    with load_pragmas(db, **pragmas):
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            c = db.cursor()
+            c.execute('BEGIN')
+            try:
+                c.executemany(q, batch)
+                db.commit()
+            except db.Error as e:
+                db.rollback()
+                raise e
+            finally:
+                c.close()
+            num_rows += len(batch)
+            bar.update(len(batch))
+    bar.close()
+    elapsed = time.time() - start
+    print('inserted {} rows into {} in {:.1f}s, {:.0f} rows/sec'.format(num_rows, table, elapsed, num_rows / max(elapsed, 1e-6)))
+    return num_rows
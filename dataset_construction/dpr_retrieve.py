@@ -4,65 +4,128 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 import argparse
-import torch
+import numpy as np
 import bz2
 import os
 import tqdm
 import ujson as json
 import spacy
+from sentence_store import SentenceEmbeddingStore
+from query_cache import QueryEmbeddingCache
+from batch_encoder import encode_bucketed
+from ann_index import IVFIndex, normalize
 
 
 class TextFinder:
 
-    def __init__(self, dpretrained_context_encoder, dpretrained_question_encoder, top_k, ent2docs, doc2sents):
+    def __init__(self, dpretrained_context_encoder, dpretrained_question_encoder, top_k, ent2docs, doc2sents, sentence_store=None, query_cache_size=1000000, fquery_cache=None, max_tokens=16384, ann_index=None, ann_top_k=100, nprobe=16):
         self.query_encoder = SentenceTransformer(dpretrained_question_encoder)
-        self.passage_encoder = SentenceTransformer(dpretrained_context_encoder)
+        self.query_cache = QueryEmbeddingCache(self.query_encoder, max_size=query_cache_size, fcache=fquery_cache)
+        # with precomputed sentence embeddings, the passage encoder is never needed
+        self.passage_encoder = SentenceTransformer(dpretrained_context_encoder) if sentence_store is None else None
+        self.sentence_store = sentence_store
         self.ent2docs = ent2docs
         self.doc2sents = doc2sents
         self.top_k = top_k
+        self.max_tokens = max_tokens
+        # with an ANN index, candidate sentences are searched over the whole corpus instead of taken from the BM25 matched docs
+        assert ann_index is None or sentence_store is not None, 'ANN retrieval requires precomputed sentence embeddings'
+        self.ann_index = ann_index
+        self.ann_top_k = ann_top_k
+        self.nprobe = nprobe
 
     def to(self, device):
-        self.query_encoder = self.query_encoder.to(device)
-        self.passage_encoder = self.passage_encoder.to(device)
+        self.query_encoder = self.query_cache.encoder = self.query_encoder.to(device)
+        if self.passage_encoder is not None:
+            self.passage_encoder = self.passage_encoder.to(device)
         return self
 
-    def lookup(self, entities, query, top_k):
-        # for each entity, look up topk docs
+    def prepare(self, entities, query):
+        # for each entity, collect the sentences of its topk docs
         indices = []
         sentences = []
         queries = []
+        rows = []
         for i, ent in enumerate(entities):
             queries.append('{}. {}'.format(ent, query))
+            if self.ann_index is not None:
+                continue
             sents_i = []
             for doc_id in self.ent2docs[ent['text']]:
                 sents_i.extend(self.doc2sents[str(doc_id)])
+                if self.sentence_store is not None:
+                    rows.append(self.sentence_store.rows(doc_id))
             sentences.extend(sents_i)
             indices.extend([i] * len(sents_i))
-        query_embedding = self.query_encoder.encode(queries, show_progress_bar=False)
-        sentence_embedding = self.passage_encoder.encode(sentences, show_progress_bar=False)
-        scores = util.cos_sim(query_embedding, sentence_embedding)
-        output = []
-        for j, sent_i, score_i in zip(indices, sentences, scores.transpose(0, 1)):
-            if j > len(output)-1:
-                output.append(dict(sents=[], scores=[]))
-            o = output[j]
-            o['sents'].append(sent_i)
-            o['scores'].append(score_i[j].item())
-
-        dpr = []
-        dpr_scores = []
-        for i, o in enumerate(output):
-            scores = torch.tensor(o['scores'])
-            values, indices = scores.topk(k=min(self.top_k, len(o['sents'])), largest=True, sorted=True)
-            ent = entities[i]
-            ordered_sents = [o['sents'][x] for x in indices.tolist()]
-            dpr.append(ordered_sents)
-            dpr_scores.append(values.tolist())
-        assert len(dpr) == len(entities)
+        return dict(indices=indices, sentences=sentences, queries=queries, rows=rows)
+
+    def retrieve_ann(self, prepared, query_embedding):
+        # replace the candidate sentences of each query with its nearest sentences in the ANN index
+        hits, _ = self.ann_index.search(query_embedding, self.ann_top_k, nprobe=self.nprobe)
+        hits = iter(hits)
+        for p in prepared:
+            p['indices'], p['sentences'], p['rows'] = [], [], []
+            for i in range(len(p['queries'])):
+                rows_i = next(hits)
+                rows_i = rows_i[rows_i >= 0]
+                for doc_id, pos in zip(*self.sentence_store.locate(rows_i)):
+                    p['sentences'].append(self.doc2sents[str(doc_id)][pos])
+                p['indices'].extend([i] * len(rows_i))
+                p['rows'].append(rows_i)
+
+    def rank(self, entities, prepared, query_embedding, sentence_embedding):
+        indices = np.asarray(prepared['indices'], dtype=np.int64)
+        sentences = prepared['sentences']
+        # cosine score of each sentence against the query of its own candidate only
+        scores = np.einsum('sd,sd->s', normalize(query_embedding)[indices], normalize(sentence_embedding))
+
+        # segmented top-k: order by candidate then by decreasing score, and keep the first top_k of each candidate
+        order = np.lexsort((-scores, indices))
+        counts = np.bincount(indices, minlength=len(entities))
+        starts = np.cumsum(counts) - counts
+        keep = order[np.arange(len(order)) - starts[indices[order]] < self.top_k]
+
+        dpr = [[] for _ in entities]
+        dpr_scores = [[] for _ in entities]
+        for i, sent, score in zip(indices[keep].tolist(), [sentences[x] for x in keep], scores[keep].tolist()):
+            dpr[i].append(sent)
+            dpr_scores[i].append(score)
         return dpr, dpr_scores
 
+    def lookup_batch(self, examples):
+        """
+        Looks up sentences for many examples at once.
+        The queries and sentences of all examples are pooled and encoded in batches bucketed by token length, then the scores are ranked per example.
+
+        Args:
+            examples: list of `(entities, query)` pairs.
+
+        Returns:
+            list of `(dpr, dpr_scores)` as returned by `lookup`, one per example.
+        """
+        prepared = [self.prepare(entities, query) for entities, query in examples]
+        query_embedding = self.query_cache.encode([q for p in prepared for q in p['queries']])
+        if self.ann_index is not None:
+            self.retrieve_ann(prepared, query_embedding)
+        if self.sentence_store is None:
+            sentence_embedding = encode_bucketed(self.passage_encoder, [s for p in prepared for s in p['sentences']], max_tokens=self.max_tokens)
+        else:
+            sentence_embedding = self.sentence_store.gather([r for p in prepared for r in p['rows']])
+
+        out = []
+        query_start = sentence_start = 0
+        for (entities, query), p in zip(examples, prepared):
+            query_end = query_start + len(p['queries'])
+            sentence_end = sentence_start + len(p['sentences'])
+            out.append(self.rank(entities, p, query_embedding[query_start:query_end], sentence_embedding[sentence_start:sentence_end]))
+            query_start, sentence_start = query_end, sentence_end
+        return out
+
+    def lookup(self, entities, query, top_k):
+        return self.lookup_batch([(entities, query)])[0]
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -73,6 +136,15 @@ if __name__ == '__main__':
     parser.add_argument('--dpretrained_question_encoder', default='./pretrained/facebook-dpr-question_encoder-multiset-base')
     parser.add_argument('--dpretrained_context_encoder', default='./pretrained/facebook-dpr-ctx_encoder-multiset-base')
     parser.add_argument('--top_k', default=20, type=int)
+    parser.add_argument('--fsent_emb', help='precomputed sentence embeddings built by sentence_store.py, encode sentences on the fly if not given')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--fquery_cache', help='file prefix to load and persist query embeddings to, with one file per query encoder, shared between runs and scripts')
+    parser.add_argument('--query_cache_size', default=1000000, type=int)
+    parser.add_argument('--example_batch_size', default=8, type=int, help='number of examples whose queries and sentences are encoded together')
+    parser.add_argument('--max_tokens', default=16384, type=int, help='maximum number of padded tokens per encoder batch')
+    parser.add_argument('--fann_index', help='ANN index built by ann_index.py, search the whole corpus instead of the BM25 matched docs if given')
+    parser.add_argument('--ann_top_k', default=100, type=int, help='number of ANN candidate sentences per query')
+    parser.add_argument('--nprobe', default=16, type=int, help='number of ANN lists searched per query')
     args = parser.parse_args()
 
     fsents = args.fdocs.replace('docs', 'sents')
@@ -111,7 +183,17 @@ if __name__ == '__main__':
                 match[k].append(doc_id)
 
     # for proc in tqdm.tqdm(loader, desc='parallel passage lookup', total=len(data)):
-    finder = TextFinder(args.dpretrained_context_encoder, args.dpretrained_question_encoder, args.top_k, match, sents).to('cuda')
+    sentence_store = None
+    if args.fsent_emb:
+        print('loading sentence embeddings')
+        sentence_store = SentenceEmbeddingStore.load(args.fsent_emb)
+
+    ann_index = None
+    if args.fann_index:
+        print('loading ann index')
+        ann_index = IVFIndex.load(args.fann_index)
+
+    finder = TextFinder(args.dpretrained_context_encoder, args.dpretrained_question_encoder, args.top_k, match, sents, sentence_store=sentence_store, query_cache_size=args.query_cache_size, fquery_cache=args.fquery_cache, max_tokens=args.max_tokens, ann_index=ann_index, ann_top_k=args.ann_top_k, nprobe=args.nprobe).to(args.device)
 
     for fname in os.listdir(args.din):
         if not fname.endswith('.bz2'):
@@ -119,12 +201,15 @@ if __name__ == '__main__':
         print('Loading {}'.format(fname))
         with bz2.open(os.path.join(args.din, fname), 'rt') as f:
             data = json.load(f)
-        for ex in tqdm.tqdm(data, desc='sentence lookup', total=len(data)):
-            dpr, dpr_scores = finder.lookup(ex['candidates'], ex['question'], args.top_k)
-            assert len(dpr) == len(dpr_scores) == len(ex['candidates'])
-            for c, r, s in zip(ex['candidates'], dpr, dpr_scores):
-                c['dpr'] = r
-                c['dpr_score'] = s
+        for i in tqdm.trange(0, len(data), args.example_batch_size, desc='sentence lookup'):
+            batch = data[i:i+args.example_batch_size]
+            for ex, (dpr, dpr_scores) in zip(batch, finder.lookup_batch([(ex['candidates'], ex['question']) for ex in batch])):
+                assert len(dpr) == len(dpr_scores) == len(ex['candidates'])
+                for c, r, s in zip(ex['candidates'], dpr, dpr_scores):
+                    c['dpr'] = r
+                    c['dpr_score'] = s
+        print('query cache', finder.query_cache.stats())
+        finder.query_cache.save()
         fout = os.path.join(args.dout, 'top_{}.'.format(args.top_k) + fname)
         with bz2.open(fout, 'wt') as f:
             json.dump(data, f)
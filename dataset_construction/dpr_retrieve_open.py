@@ -11,6 +11,8 @@ import argparse
 import ujson as json
 import bz2
 from dpr_retrieve import TextFinder
+from sentence_store import SentenceEmbeddingStore
+from ann_index import IVFIndex
 
 
 if __name__ == '__main__':
@@ -22,6 +24,15 @@ if __name__ == '__main__':
     parser.add_argument('--dpretrained_question_encoder', default='./pretrained/facebook-dpr-question_encoder-multiset-base')
     parser.add_argument('--dpretrained_context_encoder', default='./pretrained/facebook-dpr-ctx_encoder-multiset-base')
     parser.add_argument('--top_k', default=20, type=int)
+    parser.add_argument('--fsent_emb', help='precomputed sentence embeddings built by sentence_store.py, encode sentences on the fly if not given')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--fquery_cache', help='file prefix to load and persist query embeddings to, with one file per query encoder, shared between runs and scripts')
+    parser.add_argument('--query_cache_size', default=1000000, type=int)
+    parser.add_argument('--example_batch_size', default=64, type=int, help='number of examples whose queries and sentences are encoded together')
+    parser.add_argument('--max_tokens', default=16384, type=int, help='maximum number of padded tokens per encoder batch')
+    parser.add_argument('--fann_index', help='ANN index built by ann_index.py, search the whole corpus instead of the BM25 matched docs if given')
+    parser.add_argument('--ann_top_k', default=100, type=int, help='number of ANN candidate sentences per query')
+    parser.add_argument('--nprobe', default=16, type=int, help='number of ANN lists searched per query')
     args = parser.parse_args()
 
     fsents = args.fdocs.replace('docs', 'sents')
@@ -60,7 +71,17 @@ if __name__ == '__main__':
                 match[k].append(doc_id)
 
     # for proc in tqdm.tqdm(loader, desc='parallel passage lookup', total=len(data)):
-    finder = TextFinder(args.dpretrained_context_encoder, args.dpretrained_question_encoder, args.top_k, match, sents).to('cuda')
+    sentence_store = None
+    if args.fsent_emb:
+        print('loading sentence embeddings')
+        sentence_store = SentenceEmbeddingStore.load(args.fsent_emb)
+
+    ann_index = None
+    if args.fann_index:
+        print('loading ann index')
+        ann_index = IVFIndex.load(args.fann_index)
+
+    finder = TextFinder(args.dpretrained_context_encoder, args.dpretrained_question_encoder, args.top_k, match, sents, sentence_store=sentence_store, query_cache_size=args.query_cache_size, fquery_cache=args.fquery_cache, max_tokens=args.max_tokens, ann_index=ann_index, ann_top_k=args.ann_top_k, nprobe=args.nprobe).to(args.device)
 
     for fname in os.listdir(args.din):
         if not fname.endswith('.bz2'):
@@ -68,11 +89,14 @@ if __name__ == '__main__':
         print('Loading {}'.format(fname))
         with bz2.open(os.path.join(args.din, fname), 'rt') as f:
             data = json.load(f)
-        for ex in tqdm.tqdm(data, desc='sentence lookup', total=len(data)):
-            dpr, dpr_scores = finder.lookup([dict(text=ex['question'])], ex['question'], args.top_k)
-            assert len(dpr) == len(dpr_scores) == 1
-            ex['dpr'] = dpr[0]
-            ex['dpr_scores'] = dpr_scores[0]
+        for i in tqdm.trange(0, len(data), args.example_batch_size, desc='sentence lookup'):
+            batch = data[i:i+args.example_batch_size]
+            for ex, (dpr, dpr_scores) in zip(batch, finder.lookup_batch([([dict(text=ex['question'])], ex['question']) for ex in batch])):
+                assert len(dpr) == len(dpr_scores) == 1
+                ex['dpr'] = dpr[0]
+                ex['dpr_scores'] = dpr_scores[0]
+        print('query cache', finder.query_cache.stats())
+        finder.query_cache.save()
         fout = os.path.join(args.dout, 'top_{}.'.format(args.top_k) + fname)
         with bz2.open(fout, 'wt') as f:
             json.dump(data, f)
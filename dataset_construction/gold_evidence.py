@@ -0,0 +1,133 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import bz2
+import sqlite3
+import argparse
+import multiprocessing
+import ujson as json
+from tqdm.auto import tqdm
+import db_utils as D
+
+
+# facts are resolved in one join per chunk: entity and property uris to ids, ids to triples and triples to evidence spans, whose text is sliced out of the document by SQLite
+QUERY = """
+    SELECT F.id, E.doc_id, E.start, E.end, substr(D.text, E.start + 1, E.end - E.start)
+    FROM facts F
+    JOIN ents S ON S.uri = F.subj
+    JOIN ents O ON O.uri = F.obj
+    JOIN props P ON P.uri = F.prop
+    JOIN trips T ON T.subj_id = S.id AND T.obj_id = O.id AND T.prop_id = P.id
+    JOIN evidence E ON E.trip_id = T.id
+    JOIN docs D ON D.id = E.doc_id
+    ORDER BY F.id, E.id
+"""
+
+
+def ensure_indexes(fdb):
+    """
+    Adds the covering indexes the evidence join needs, on the uris of ents and props, trips(subj_id, obj_id, prop_id) and evidence(trip_id, ...), if the database does not have them yet.
+    """
+    db = sqlite3.connect(fdb)
+    D.create_indexes(db, ['ents', 'props', 'trips', 'evidence'])
+    db.close()
+
+
+def connect_readonly(fdb):
+    return sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(fdb)), uri=True)
+
+
+def fact_of(candidate, constraint):
+    """
+    Returns the (subj, obj, prop) uris of the fact that `constraint` states about `candidate`.
+    """
+    if constraint['prop_dir'] == 'subj':
+        subj, obj = candidate['uri'], constraint['other_ent']['uri']
+    elif constraint['prop_dir'] == 'obj':
+        subj, obj = constraint['other_ent']['uri'], candidate['uri']
+    else:
+        raise ValueError('unknown prop_dir {!r}'.format(constraint['prop_dir']))
+    return subj, obj, constraint['prop']['uri']
+
+
+def resolve_facts(db, facts):
+    """
+    Returns the evidence of each fact of `facts`, a list of (subj, obj, prop) uris, through the connection `db`.
+    As in `03 - retrieve_evidence.ipynb`, spans with the same text are kept once.
+    """
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS facts(id INTEGER PRIMARY KEY, subj TEXT, obj TEXT, prop TEXT)')
+    db.execute('DELETE FROM facts')
+    db.executemany('INSERT INTO facts VALUES (?, ?, ?, ?)', [(i, s, o, p) for i, (s, o, p) in enumerate(facts)])
+    matches = [{} for _ in facts]
+    for i, doc_id, start, end, text in db.execute(QUERY):
+        matches[i][text] = dict(doc_id=doc_id, start=start, end=end)
+    out = []
+    for match in matches:
+        lst = []
+        for k, v in match.items():
+            v['text'] = k
+            lst.append(v)
+        out.append(lst)
+    return out
+
+
+def init_worker(fdb):
+    global worker_db
+    worker_db = connect_readonly(fdb)
+
+
+def resolve_chunk(facts):
+    return resolve_facts(worker_db, facts)
+
+
+def retrieve_facts(fdb, facts, num_workers=8, chunk_size=10000):
+    """
+    Resolves `facts` in chunks spread over `num_workers` processes, each with its own read-only connection.
+
+    Returns:
+        dictionary mapping each fact to its evidence.
+    """
+    facts = sorted(set(facts))
+    chunks = [facts[i:i+chunk_size] for i in range(0, len(facts), chunk_size)]
+    out = {}
+    with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(fdb, )) as pool:
+        for chunk, evidence in tqdm(zip(chunks, pool.imap(resolve_chunk, chunks)), total=len(chunks), desc='resolving facts'):
+            out.update(zip(chunk, evidence))
+    return out
+
+
+def map_split(examples, fact2evidence):
+    """
+    Adds the gold `evidence` of each candidate of `examples`, in place.
+    """
+    for ex in examples:
+        for c in ex['candidates']:
+            c['evidence'] = []
+            for constraint in ex['constraints']:
+                c['evidence'].extend(fact2evidence[fact_of(c, constraint)])
+    return examples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--fdb', help='database with the T-REx triples and evidence', default='annotations/data.db')
+    parser.add_argument('--din', help='directory of the mapped splits', default='.')
+    parser.add_argument('--dout', help='output directory', default='evidence/gold')
+    parser.add_argument('--splits', nargs='+', default=['dev', 'test.noanswer', 'train'])
+    parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--chunk_size', default=10000, type=int, help='facts resolved per join')
+    args = parser.parse_args()
+
+    ensure_indexes(args.fdb)
+    os.makedirs(args.dout, exist_ok=True)
+    for split in args.splits:
+        with open(os.path.join(args.din, '{}.json'.format(split)), 'rt') as f:
+            examples = json.load(f)
+        facts = [fact_of(c, constraint) for ex in examples for c in ex['candidates'] for constraint in ex['constraints']]
+        fact2evidence = retrieve_facts(args.fdb, facts, num_workers=args.num_workers, chunk_size=args.chunk_size)
+        with bz2.open(os.path.join(args.dout, '{}.json.bz2'.format(split)), 'wt') as f:
+            json.dump(map_split(examples, fact2evidence), f)
@@ -0,0 +1,74 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import torch
+import pickle
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from batch_encoder import encode_bucketed
+
+
+def encoder_digest(encoder):
+    """
+    Hashes the modules of `encoder`, with their settings such as the maximum sequence length and pooling, and every value of its weights.
+    """
+    h = hashlib.sha1()
+    h.update('{}|{}'.format(encoder, encoder.max_seq_length).encode('utf-8'))
+    for name, v in encoder.state_dict().items():
+        h.update('{}{}{}'.format(name, v.dtype, tuple(v.shape)).encode('utf-8'))
+        h.update(v.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache in front of a `SentenceTransformer` query encoder.
+    Only the distinct queries that are not cached are sent to the encoder, in one call.
+    If `fcache` is given, the cache is loaded on construction and written back by `save` to a file named after `fcache` and the digest of the encoder, so that embeddings of different encoders are never mixed.
+    """
+
+    def __init__(self, encoder, max_size=1000000, fcache=None):
+        self.encoder = encoder
+        self.max_size = max_size
+        self.fcache = None if fcache is None else '{}.{}'.format(fcache, encoder_digest(encoder)[:16])
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        if self.fcache is not None and os.path.isfile(self.fcache):
+            with open(self.fcache, 'rb') as f:
+                keys, values = pickle.load(f)
+            for k, v in zip(keys[-max_size:], values[-max_size:]):
+                self.cache[k] = v
+
+    def encode(self, queries):
+        missing = [q for q in OrderedDict.fromkeys(queries) if q not in self.cache]
+        # repeats of a missing query within the same call are served by its single encoding, so they count as hits
+        self.misses += len(missing)
+        self.hits += len(queries) - len(missing)
+        if missing:
+            for q, v in zip(missing, encode_bucketed(self.encoder, missing)):
+                self.cache[q] = v
+        out = []
+        for q in queries:
+            self.cache.move_to_end(q)
+            out.append(self.cache[q])
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        if not out:
+            return np.zeros((0, self.encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack(out)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self.cache), hits=self.hits, misses=self.misses, hit_rate=self.hits / max(1, total))
+
+    def save(self):
+        if self.fcache is None:
+            return
+        # keys are written from least to most recently used so that reloading a smaller cache keeps the most recent entries
+        with open(self.fcache, 'wb') as f:
+            pickle.dump((list(self.cache.keys()), np.stack(list(self.cache.values())) if self.cache else []), f)
@@ -0,0 +1,102 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import bz2
+import argparse
+import numpy as np
+import ujson as json
+import tqdm
+from sentence_transformers import SentenceTransformer
+
+
+class SentenceEmbeddingStore:
+    """
+    Precomputed passage embeddings for every sentence of the corpus.
+    Sentences are numbered document by document in increasing document id order, so the sentences of document `doc_ids[i]` are rows `doc_offsets[i]` to `doc_offsets[i+1]` of the float16 `embeddings` matrix, in the same order as in the sents corpus.
+    """
+
+    def __init__(self, doc_ids, doc_offsets, embeddings):
+        self.doc_ids = doc_ids
+        self.doc_offsets = doc_offsets
+        self.embeddings = embeddings
+
+    @classmethod
+    def load(cls, din, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            doc_ids=np.load(os.path.join(din, 'doc_ids.npy'), mmap_mode=mmap_mode),
+            doc_offsets=np.load(os.path.join(din, 'doc_offsets.npy'), mmap_mode=mmap_mode),
+            embeddings=np.load(os.path.join(din, 'embeddings.npy'), mmap_mode=mmap_mode),
+        )
+
+    @classmethod
+    def build(cls, doc2sents, encoder, dout, chunk_size=100000, batch_size=256):
+        """
+        Encodes every sentence once and writes the store to `dout`.
+
+        Args:
+            doc2sents: dictionary mapping document ids to lists of sentences.
+            encoder: `SentenceTransformer` passage encoder.
+            dout: output directory.
+            chunk_size: number of sentences to encode between writes.
+            batch_size: encoder batch size.
+        """
+        os.makedirs(dout, exist_ok=True)
+        doc_ids = sorted(doc2sents.keys(), key=int)
+        doc_offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+        doc_offsets[1:] = np.cumsum([len(doc2sents[d]) for d in doc_ids])
+        np.save(os.path.join(dout, 'doc_ids.npy'), np.array(doc_ids, dtype=np.int64))
+        np.save(os.path.join(dout, 'doc_offsets.npy'), doc_offsets)
+
+        shape = (int(doc_offsets[-1]), encoder.get_sentence_embedding_dimension())
+        embeddings = np.lib.format.open_memmap(os.path.join(dout, 'embeddings.npy'), mode='w+', dtype=np.float16, shape=shape)
+        sentences = (s for d in doc_ids for s in doc2sents[d])
+        for start in tqdm.trange(0, shape[0], chunk_size, desc='encoding sentences'):
+            chunk = [next(sentences) for _ in range(min(chunk_size, shape[0] - start))]
+            embeddings[start:start+len(chunk)] = encoder.encode(chunk, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+        embeddings.flush()
+        return cls.load(dout)
+
+    def rows(self, doc_id):
+        """
+        Returns the row indices of the sentences of a document.
+        """
+        i = np.searchsorted(self.doc_ids, int(doc_id))
+        assert i < len(self.doc_ids) and self.doc_ids[i] == int(doc_id), 'Document {} is not in the store'.format(doc_id)
+        return np.arange(self.doc_offsets[i], self.doc_offsets[i+1])
+
+    def locate(self, rows):
+        """
+        Returns the document ids of sentence rows and the positions of the sentences within their documents.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        i = np.searchsorted(self.doc_offsets, rows, side='right') - 1
+        return self.doc_ids[i], rows - self.doc_offsets[i]
+
+    def gather(self, rows):
+        """
+        Returns the float32 embeddings of a list of row index arrays, concatenated in order.
+        """
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        return np.asarray(self.embeddings[rows], dtype=np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--fsents', help='sentence corpus produced by dpr_retrieve.py', default='evidence/sorted_sents.json.bz2')
+    parser.add_argument('--dout', help='output store directory', default='evidence/sent_emb')
+    parser.add_argument('--dpretrained_context_encoder', default='./pretrained/facebook-dpr-ctx_encoder-multiset-base')
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--device', default='cuda')
+    args = parser.parse_args()
+
+    print('loading sentences')
+    with bz2.open(args.fsents, 'rt') as f:
+        sents = json.load(f)
+
+    encoder = SentenceTransformer(args.dpretrained_context_encoder, device=args.device)
+    SentenceEmbeddingStore.build(sents, encoder, args.dout, batch_size=args.batch_size)
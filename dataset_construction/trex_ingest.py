@@ -0,0 +1,126 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import bz2
+import sqlite3
+import zipfile
+import argparse
+import functools
+import multiprocessing
+import ujson as json
+from tqdm.auto import tqdm
+import db_utils as D
+
+
+def checkpoint_files(dcheckpoint, member):
+    name = os.path.join(dcheckpoint, os.path.basename(member).replace('.json', ''))
+    return name + '.docs.jsonl.bz2', name + '.trips.jsonl.bz2'
+
+
+def parse_member(member, ftrex, dcheckpoint):
+    """
+    Parses one json file of the T-REx zip and writes its distinct documents and (subj, prop, obj, docid, start, end) evidence triples to its checkpoint files.
+    Files are written under temporary names and renamed once complete, so that an interrupted run parses the member again.
+
+    Returns:
+        the number of documents and evidence triples of the member.
+    """
+    docs = {}
+    trips = set()
+    with zipfile.ZipFile(ftrex) as fz:
+        with fz.open(member) as f:
+            data = json.load(f)
+    for doc in data:
+        if doc['docid'] in docs:
+            assert doc['text'] == docs[doc['docid']][2]
+        else:
+            docs[doc['docid']] = (doc['uri'], doc['title'], doc['text'])
+        for t in doc['triples']:
+            sent_start, sent_end = doc['sentences_boundaries'][t['sentence_id']]
+            trips.add((t['subject']['uri'], t['predicate']['uri'], t['object']['uri'], doc['docid'], sent_start, sent_end))
+    del data
+    fdocs, ftrips = checkpoint_files(dcheckpoint, member)
+    for fname, rows in [(ftrips, sorted(trips)), (fdocs, [(k, ) + v for k, v in docs.items()])]:
+        with bz2.open(fname + '.tmp', 'wt') as f:
+            for r in rows:
+                f.write(json.dumps(r) + '\n')
+        os.replace(fname + '.tmp', fname)
+    return len(docs), len(trips)
+
+
+def iter_checkpoints(fnames):
+    for fname in fnames:
+        with bz2.open(fname, 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def make_staging_tables(db):
+    for t in ['raw_docs', 'raw_trips', 'trex_docs', 'trex_trips', 'trex_evidence']:
+        db.execute('DROP TABLE IF EXISTS {}'.format(t))
+    db.execute('CREATE TABLE raw_docs(docid TEXT, uri TEXT, title TEXT, text TEXT)')
+    db.execute('CREATE TABLE raw_trips(subj TEXT, prop TEXT, obj TEXT, docid TEXT, start INTEGER, end INTEGER)')
+    db.commit()
+
+
+def finalize(db):
+    """
+    Deduplicates the documents and triples of all members into numbered tables, ordered as the sorted `docs` and `evidence` keys of `01 - construct_data.ipynb` were:
+
+        trex_docs(id, docid, uri, title, text)
+        trex_trips(id, subj, prop, obj)
+        trex_evidence(trip_id, doc_id, start, end)
+
+    SQLite sorts on disk, so this does not hold the corpus in memory either.
+    """
+    conflicts = db.execute('SELECT COUNT(*) FROM (SELECT docid FROM raw_docs GROUP BY docid HAVING COUNT(DISTINCT text) > 1)').fetchone()[0]
+    assert conflicts == 0, '{} documents have different texts in different members'.format(conflicts)
+    with D.load_pragmas(db):
+        for q in tqdm([
+            'CREATE TABLE trex_docs(id INTEGER PRIMARY KEY, docid TEXT, uri TEXT, title TEXT, text TEXT)',
+            'INSERT INTO trex_docs SELECT ROW_NUMBER() OVER (ORDER BY docid) - 1, docid, uri, title, text FROM (SELECT docid, uri, title, text FROM raw_docs GROUP BY docid)',
+            'CREATE UNIQUE INDEX trex_docs_docid ON trex_docs(docid)',
+            'CREATE TABLE trex_trips(id INTEGER PRIMARY KEY, subj TEXT, prop TEXT, obj TEXT)',
+            'INSERT INTO trex_trips SELECT ROW_NUMBER() OVER (ORDER BY subj, prop, obj) - 1, subj, prop, obj FROM (SELECT DISTINCT subj, prop, obj FROM raw_trips)',
+            'CREATE UNIQUE INDEX trex_trips_key ON trex_trips(subj, prop, obj)',
+            'CREATE TABLE trex_evidence(trip_id INTEGER NOT NULL, doc_id INTEGER NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL)',
+            'INSERT INTO trex_evidence SELECT DISTINCT T.id, D.id, R.start, R.end FROM raw_trips R JOIN trex_trips T ON T.subj = R.subj AND T.prop = R.prop AND T.obj = R.obj JOIN trex_docs D ON D.docid = R.docid ORDER BY 1, 2, 3, 4',
+            'CREATE INDEX trex_evidence_trip ON trex_evidence(trip_id)',
+            'DROP TABLE raw_docs',
+            'DROP TABLE raw_trips',
+        ], desc='deduplicating'):
+            db.execute(q)
+            db.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--ftrex', help='T-REx zip', default='trex.zip')
+    parser.add_argument('--fdb', help='output database of deduplicated T-REx documents and triples', default='checkpoint/trex.db')
+    parser.add_argument('--dcheckpoint', help='directory of the parsed members', default='checkpoint/trex')
+    parser.add_argument('--num_workers', default=16, type=int)
+    args = parser.parse_args()
+
+    os.makedirs(args.dcheckpoint, exist_ok=True)
+    with zipfile.ZipFile(args.ftrex) as fz:
+        members = [m for m in fz.namelist() if m.endswith('.json')]  # there are 465 files
+    todo = [m for m in members if not all(os.path.isfile(f) for f in checkpoint_files(args.dcheckpoint, m))]
+    print('parsing {} of {} members, the others were parsed by a previous run'.format(len(todo), len(members)))
+    # each worker holds one member at a time, instead of the whole corpus
+    with multiprocessing.Pool(args.num_workers, maxtasksperchild=1) as pool:
+        bar = tqdm(pool.imap_unordered(functools.partial(parse_member, ftrex=args.ftrex, dcheckpoint=args.dcheckpoint), todo), total=len(todo), desc='parsing members')
+        for num_docs, num_trips in bar:
+            bar.set_postfix(docs=num_docs, trips=num_trips)
+
+    db = sqlite3.connect(args.fdb, isolation_level=None)
+    make_staging_tables(db)
+    ckpts = [checkpoint_files(args.dcheckpoint, m) for m in members]
+    D.bulk_insert(db, 'raw_docs', iter_checkpoints([fdocs for fdocs, _ in ckpts]))
+    D.bulk_insert(db, 'raw_trips', iter_checkpoints([ftrips for _, ftrips in ckpts]))
+    finalize(db)
+    counts = {t: db.execute('SELECT COUNT(*) FROM {}'.format(t)).fetchone()[0] for t in ['trex_docs', 'trex_trips', 'trex_evidence']}
+    print('{trex_docs} docs, {trex_trips} triplets, {trex_evidence} evidence'.format(**counts))
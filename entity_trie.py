@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import time
+import torch
+import sqlite3
+import argparse
+import omegaconf
+import numpy as np
+from collections import Counter
+
+
+class EntityTrie:
+    """
+    Token level prefix trie over token id sequences.
+    Each node is a list of its children keyed by token id, the number of sequences below it and the index of the sequence ending at it, or -1.
+    """
+
+    def __init__(self, sequences):
+        self.root = [{}, 0, -1]
+        self.paths = {}
+        for i, ids in enumerate(sequences):
+            ids = tuple(ids)
+            end = self.find(ids)
+            if not ids or end is not None and end[2] >= 0:
+                # names that tokenize the same can not be told apart, keep the first
+                continue
+            self.paths[i] = ids
+            node = self.root
+            node[1] += 1
+            for t in ids:
+                node = node[0].setdefault(t, [{}, 0, -1])
+                node[1] += 1
+            node[2] = i
+
+    def find(self, ids):
+        node = self.root
+        for t in ids:
+            node = node[0].get(t)
+            if node is None:
+                return None
+        return node
+
+    def allowed(self, node, prefix, exclude):
+        """
+        Returns the children of `node`, reached by `prefix`, below which some sequence is not in `exclude`.
+        """
+        used = Counter()
+        for i in exclude:
+            path = self.paths.get(i)
+            if path is not None and len(path) > len(prefix) and path[:len(prefix)] == prefix:
+                used[path[len(prefix)]] += 1
+        if not used:
+            return list(node[0].keys())
+        return [t for t, child in node[0].items() if child[1] > used[t]]
+
+
+class EntityConstraint:
+    """
+    Restricts generation to comma separated lists of distinct entity names, in the `'a, b, c'` format of `seq2seq` labels.
+    The first name and the `', '` prefixed following names are each kept in a trie, so that separators tokenize as they do within a label.
+    Once every name has been generated, or the generated name can not be continued, the only allowed token is eos.
+    """
+
+    def __init__(self, tokenizer, names):
+        self.names = list(names)
+        self.eos = tokenizer.eos_token_id
+        self.bos = tokenizer.bos_token_id
+        self.skip = {tokenizer.pad_token_id, tokenizer.bos_token_id}
+        self.first = EntityTrie([tokenizer.encode(n, add_special_tokens=False) for n in self.names])
+        self.rest = EntityTrie([tokenizer.encode(', ' + n, add_special_tokens=False) for n in self.names])
+        # <s>, the names with their separators and </s>
+        self.max_length = 2 + sum(len(p) for p in self.rest.paths.values())
+
+    def allowed_tokens(self, input_ids):
+        """
+        Returns the tokens that may follow the decoder tokens `input_ids`, which start with the decoder start token.
+        """
+        input_ids = input_ids.tolist() if torch.is_tensor(input_ids) else list(input_ids)
+        start = 0
+        while start < len(input_ids) and input_ids[start] in self.skip:
+            start += 1
+        trie, node, prefix, emitted = self.first, self.first.root, (), []
+        for t in input_ids[start:]:
+            if t == self.eos:
+                return [self.eos]
+            if t in node[0]:
+                node, prefix = node[0][t], prefix + (t, )
+            elif node[2] >= 0 and t in self.rest.root[0]:
+                emitted.append(node[2])
+                trie, node, prefix = self.rest, self.rest.root[0][t], (t, )
+            else:
+                return [self.eos]
+        allowed = trie.allowed(node, prefix, emitted)
+        if node[2] >= 0 and node[2] not in emitted:
+            allowed += self.rest.allowed(self.rest.root, (), emitted + [node[2]])
+            allowed.append(self.eos)
+        elif start == len(input_ids):
+            # nothing generated yet: the answer may be empty, and models that start labels with <s> may generate it first
+            allowed.append(self.eos)
+            if len(input_ids) == 1 and self.bos is not None:
+                allowed.append(self.bos)
+        return allowed or [self.eos]
+
+
+def load_entity_names(fentities):
+    """
+    Returns the distinct names of the `ents` table of the SQLite database `fentities`.
+    """
+    db = sqlite3.connect(fentities)
+    names = sorted({text for text, in db.execute('SELECT text FROM ents') if text})
+    db.close()
+    return names
+
+
+def validity(pred, names):
+    """
+    Returns the fraction of predicted entities that are among their allowed `names`, and the fraction of predictions that only contain such entities.
+    """
+    valid = [[e in n for e in p] for p, n in zip(pred, names)]
+    return dict(
+        entity_validity=float(np.mean([v for vs in valid for v in vs])) if any(valid) else 1.,
+        output_validity=float(np.mean([all(vs) for vs in valid])) if valid else 1.,
+    )
+
+
+def compare(model, raw, dataset, batch_size, global_names=None):
+    """
+    Reports the decoding latency, output validity and metrics of `model` with unconstrained and with entity constrained generation.
+    """
+    from evaluation import evaluate
+    from cpu_inference import predict_batches
+    examples = list(dataset)
+    global_names = set(global_names or ())
+    names = [global_names or set(ex['names']) for ex in examples]
+    results = []
+    for constrained in [False, True]:
+        model.hparams.constrained_decoding = constrained
+        start = time.time()
+        pred = predict_batches(model, examples, batch_size)
+        elapsed = time.time() - start
+        metrics = evaluate(raw, pred)
+        results.append(dict(constrained=constrained, ms_per_example=1000 * elapsed / max(1, len(examples)), f1=metrics['f1'], complete_f1=metrics['complete_f1_@kNone'], **validity(pred, names)))
+    return results
+
+
+if __name__ == '__main__':
+    from wrangl.learn import SupervisedModel
+    from cpu_inference import ROOT_DIR, iter_batches
+    from train_baselines import load_eval_split
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dsave', help='save folder of a seq2seq experiment')
+    parser.add_argument('--fsave', default='last.ckpt', help='checkpoint file')
+    parser.add_argument('--fdata', default='dataset_construction/evidence/closed/top_5.dev.json.bz2', help='data file with answers to compare on')
+    parser.add_argument('--fentities', help='SQLite database whose ents table constrains every example instead of its candidates, for the open setting')
+    parser.add_argument('--num_examples', default=200, type=int, help='compare on the first examples only')
+    parser.add_argument('--batch_size', default=None, type=int)
+    args = parser.parse_args()
+
+    cfg = omegaconf.OmegaConf.load(os.path.join(args.dsave, 'config.yaml'))
+    if args.fentities:
+        cfg.fentities = args.fentities
+    Model = SupervisedModel.load_model_class(cfg.model, root_dir=ROOT_DIR)
+    model = Model.load_from_checkpoint(os.path.join(args.dsave, args.fsave), map_location='cpu').configure_inference(cfg).eval()
+    raw, dataset = load_eval_split(args.fdata, Model)
+    raw = raw[:args.num_examples]
+    dataset = next(iter_batches(dataset, args.num_examples), [])
+    global_names = load_entity_names(cfg.fentities) if cfg.get('fentities') else None
+    for r in compare(model, raw, dataset, args.batch_size or cfg.val_batch_size, global_names=global_names):
+        print(r)
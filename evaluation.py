@@ -6,6 +6,7 @@
 
 import os
 import bz2
+import numpy as np
 import ujson as json
 from typing import List, Set
 from collections import defaultdict
@@ -81,52 +82,181 @@ class SetF1(Metric):
         return {k: (sum(v)/len(v)) for k, v in metrics.items()}
 
 
-def evaluate_gold(cluster_ids: List[int], gold: List[Set], pred: List[Set]):
-    assert len(cluster_ids) == len(pred)
-    assert len(gold) == len(pred)
-    f1 = SetF1()
-    acc = Accuracy()
-    metrics = f1(pred, gold, ignore_empty=True)
-    metrics.update(acc(pred, gold))
-
-    cluster_metrics = defaultdict(lambda: defaultdict(list))
-    per_example = []
-    for c, p, g in zip(cluster_ids, pred, gold):
-        this = dict()
-        this_f1 = this['f1'] = f1([p], [g])
-        for k, v in this_f1.items():
-            cluster_metrics[c][k].append(v)
-        this_acc = this['acc'] = acc([p], [g])
-        for k, v in this_acc.items():
-            cluster_metrics[c][k].append(v)
-        per_example.append(this)
-
-    mins = defaultdict(list)
-    for m in cluster_metrics.values():
-        for k, vs in m.items():
-            mins[k].append(min(vs))
-
-    for k, v in mins.items():
-        metrics['cluster_min_{}'.format(k)] = sum(v) / len(v)
-    return metrics, per_example
+def open_data(fname):
+    return bz2.open(fname, 'rt') if fname.endswith('.bz2') else open(fname, 'rt')
 
 
-def evaluate(data: List[dict], pred: List[OrderedSet], return_per_pred=False):
-    cluster_ids = [ex['cluster_id'] for ex in data]
-    gold = [{c['text'] for c in ex['candidates'] if c['is_answer']} for ex in data]
-    all_gold = [{a['text'] for a in ex['complete_answer']} for ex in data]
+def is_jsonl(fname):
+    return fname.endswith('.jsonl') or fname.endswith('.jsonl.bz2')
+
+
+def iter_examples(fname: str):
+    """
+    Iterates over the examples of a split.
+    Line-delimited `.jsonl` or `.jsonl.bz2` files are decoded one example at a time, other files are loaded whole.
+    """
+    with open_data(fname) as f:
+        if is_jsonl(fname):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def compact_example(ex: dict):
+    """
+    Keeps only the fields needed to evaluate and to write predictions for an example, dropping evidence.
+    """
+    out = dict(
+        id=ex['id'],
+        cluster_id=ex['cluster_id'],
+        candidates=[dict(text=c['text'], is_answer=c.get('is_answer', False)) for c in ex['candidates']],
+    )
+    if 'complete_answer' in ex:
+        out['complete_answer'] = [dict(text=a['text']) for a in ex['complete_answer']]
+    return out
+
+
+class Evaluator:
+    """
+    Vectorized equivalent of `evaluate` for a fixed list of examples.
+    Answer strings are interned to integer ids once, then each call to `evaluate` scores predictions against the gold answers and the complete answers at every top k in a single pass over the predicted entities.
+    The metrics are identical to those of `SetF1` and `Accuracy` applied to each example, with the minimum of each cluster averaged over clusters, including the order in which they are summed.
+    """
+
+    TOP_K = [1, 10, 100, None]
+
+    def __init__(self, data: List[dict]):
+        self.num_examples = len(data)
+        self.vocab = {}
+        _, first, self.cluster_index = np.unique(np.array([ex['cluster_id'] for ex in data]), return_index=True, return_inverse=True)
+        self.cluster_index = self.cluster_index.reshape(-1)
+        # examples grouped by cluster, for taking minimums with `reduceat`
+        self.by_cluster = np.argsort(self.cluster_index, kind='stable')
+        self.cluster_starts = np.searchsorted(self.cluster_index[self.by_cluster], np.arange(len(first)))
+        # clusters are averaged in order of first appearance
+        self.cluster_order = np.argsort(first, kind='stable')
+        self.gold = self.intern([{c['text'] for c in ex['candidates'] if c['is_answer']} for ex in data])
+        self.all_gold = self.intern([{a['text'] for a in ex['complete_answer']} for ex in data])
+
+    def intern(self, gold: List[Set]):
+        pairs = sorted((i << 32) | self.vocab.setdefault(t, len(self.vocab)) for i, g in enumerate(gold) for t in g)
+        return dict(
+            pairs=np.array(pairs, dtype=np.int64),
+            size=np.array([len(g) for g in gold], dtype=np.int64),
+            keep=np.array([bool(g) and g != {''} for g in gold]),
+        )
+
+    def score(self, gold, example, rank, match, num_pred, top_k=None):
+        if top_k is not None:
+            match = match & (rank < top_k)
+            num_pred = np.minimum(num_pred, top_k)
+        common = np.bincount(example[match], minlength=self.num_examples)
+        precision = common / np.maximum(1, num_pred)
+        recall = common / np.maximum(1, gold['size'])
+        denom = precision + recall
+        f1 = np.where(denom > 0, precision * recall * 2 / np.where(denom > 0, denom, 1), 0.)
+        acc = (common == num_pred) & (num_pred == gold['size'])
+        per_example = dict(f1=f1, recall=recall, precision=precision, acc=acc.astype(np.float64))
+
+        keep = gold['keep']
+        metrics = {k: sum(per_example[k][keep].tolist()) / int(keep.sum()) for k in ['f1', 'recall', 'precision']}
+        metrics['acc'] = sum(acc.tolist()) / self.num_examples
+        for k, v in per_example.items():
+            mins = np.minimum.reduceat(v[self.by_cluster], self.cluster_starts) if len(v) else v
+            metrics['cluster_min_{}'.format(k)] = sum(mins[self.cluster_order].tolist()) / len(mins)
+        return metrics, per_example
 
-    m, per_pred = evaluate_gold(cluster_ids, gold, pred)
+    @classmethod
+    def to_per_example(cls, per_example):
+        f1, recall, precision, acc = [per_example[k].tolist() for k in ['f1', 'recall', 'precision', 'acc']]
+        return [dict(f1=dict(f1=a, recall=b, precision=c), acc=dict(acc=d)) for a, b, c, d in zip(f1, recall, precision, acc)]
 
-    all_per_pred = {}
-    for top_k in [1, 10, 100, None]:
-        pred_k = [p[:top_k] for p in pred]
-        all_ans, all_per_pred[top_k] = evaluate_gold(cluster_ids, all_gold, pred_k)
-        for k, v in all_ans.items():
-            m['complete_{}_@k{}'.format(k, top_k)] = v
-    if return_per_pred:
-        return m, per_pred, all_per_pred
-    return m
+    def evaluate(self, pred: List[OrderedSet], return_per_pred=False):
+        assert len(pred) == self.num_examples
+        num_pred = np.array([len(p) for p in pred], dtype=np.int64)
+        get = self.vocab.get
+        entity = np.fromiter((get(t, -1) for p in pred for t in p), dtype=np.int64, count=int(num_pred.sum()))
+        example = np.repeat(np.arange(self.num_examples, dtype=np.int64), num_pred)
+        rank = np.arange(len(entity)) - np.repeat(np.cumsum(num_pred) - num_pred, num_pred)
+        pairs = (example << 32) | np.maximum(entity, 0)
+
+        def match(gold):
+            pos = np.minimum(np.searchsorted(gold['pairs'], pairs), max(len(gold['pairs']) - 1, 0))
+            # strings never seen in the gold answers cannot match
+            return (entity >= 0) & (gold['pairs'][pos] == pairs) if len(gold['pairs']) else np.zeros(len(pairs), dtype=bool)
+
+        m, per_pred = self.score(self.gold, example, rank, match(self.gold), num_pred)
+        all_per_pred = {}
+        all_match = match(self.all_gold)
+        for top_k in self.TOP_K:
+            all_ans, all_per_pred[top_k] = self.score(self.all_gold, example, rank, all_match, num_pred, top_k=top_k)
+            for k, v in all_ans.items():
+                m['complete_{}_@k{}'.format(k, top_k)] = v
+        if return_per_pred:
+            return m, self.to_per_example(per_pred), {k: self.to_per_example(v) for k, v in all_per_pred.items()}
+        return m
+
+
+class StreamingEvaluator:
+    """
+    Incremental equivalent of `evaluate` that is fed one `(example, prediction)` pair at a time, for instance as batches come out of inference.
+    It keeps running sums of the example metrics and the running minimum of each metric per cluster, so `metrics` can be called at any point to get the metrics of the examples seen so far.
+    """
+
+    TOP_K = [1, 10, 100, None]
+
+    def __init__(self):
+        self.num_examples = 0
+        self.f1 = SetF1()
+        self.states = {key: self.new_state() for key in ['gold'] + self.TOP_K}
+
+    @classmethod
+    def new_state(cls):
+        return dict(sums=dict(f1=0, recall=0, precision=0), num_kept=0, acc=0, clusters={})
+
+    def update(self, state, cluster_id, gold: Set, pred: OrderedSet):
+        m = self.f1.compute_one(pred, gold)
+        m = dict(f1=m['f1'], recall=m['recall'], precision=m['precision'], acc=float(pred == gold))
+        if gold and gold != {''}:
+            state['num_kept'] += 1
+            for k in state['sums']:
+                state['sums'][k] += m[k]
+        state['acc'] += pred == gold
+        mins = state['clusters'].setdefault(cluster_id, {})
+        for k, v in m.items():
+            mins[k] = min(mins.get(k, v), v)
+
+    def add(self, example: dict, pred: OrderedSet):
+        gold = {c['text'] for c in example['candidates'] if c['is_answer']}
+        all_gold = {a['text'] for a in example.get('complete_answer', ())}
+        self.update(self.states['gold'], example['cluster_id'], gold, pred)
+        for top_k in self.TOP_K:
+            self.update(self.states[top_k], example['cluster_id'], all_gold, pred[:top_k])
+        self.num_examples += 1
+
+    def summarize(self, state):
+        metrics = {k: v / max(1, state['num_kept']) for k, v in state['sums'].items()}
+        metrics['acc'] = state['acc'] / max(1, self.num_examples)
+        for k in ['f1', 'recall', 'precision', 'acc']:
+            mins = [m[k] for m in state['clusters'].values()]
+            metrics['cluster_min_{}'.format(k)] = sum(mins) / max(1, len(mins))
+        return metrics
+
+    def metrics(self):
+        """
+        Returns the metrics of the examples seen so far, with the same keys as `evaluate`.
+        """
+        m = self.summarize(self.states['gold'])
+        for top_k in self.TOP_K:
+            for k, v in self.summarize(self.states[top_k]).items():
+                m['complete_{}_@k{}'.format(k, top_k)] = v
+        return m
+
+
+def evaluate(data: List[dict], pred: List[OrderedSet], return_per_pred=False):
+    return Evaluator(data).evaluate(pred, return_per_pred=return_per_pred)
 
 
 if __name__ == '__main__':
@@ -142,8 +272,7 @@ if __name__ == '__main__':
             print(os.path.join(root, f))
 
     print('Loading data')
-    with bz2.open(cfg.fdata, 'rt') as f:
-        val = json.load(f)
+    val = [compact_example(ex) for ex in iter_examples(cfg.fdata)]
 
     with open(cfg.fpred) as f:
         pred = json.load(f)
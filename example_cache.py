@@ -0,0 +1,166 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import json
+import uuid
+import pickle
+import random
+import shutil
+import hashlib
+import numpy as np
+from tqdm.auto import tqdm
+from collections import defaultdict
+from torch.utils.data import Dataset
+from evaluation import iter_examples, compact_example
+
+
+def file_digest(fname, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def model_digest(Model):
+    """
+    Hashes the source files of the model class and of its bases up to `SupervisedModel`, so that editing how examples are processed invalidates the cache.
+    Model files are loaded by path without being registered as modules, so the files are found through the code of their methods.
+    Only the source is covered: processing that depends on the tokenizer or on config values is not part of the digest, so the cache directory must be cleared when those change.
+    """
+    fnames = set()
+    for cls in Model.__mro__:
+        if cls.__module__.startswith('wrangl'):
+            break
+        for v in vars(cls).values():
+            code = getattr(getattr(v, '__func__', v), '__code__', None)
+            if code is not None and os.path.isfile(code.co_filename):
+                fnames.add(code.co_filename)
+    h = hashlib.sha1()
+    for fname in sorted(fnames):
+        with open(fname, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class CompiledDataset(Dataset):
+    """
+    Processed examples of a split, compiled once to a directory of memory-mapped columns.
+    Each top level field of the processed examples is a column made of a byte buffer of pickled cells and an offset index, so examples can be read in any order without holding the split in memory.
+    The directory also holds the compact raw examples, see `evaluation.compact_example`, for scoring and writing predictions.
+    """
+
+    def __init__(self, dcache, indices=None):
+        self.dcache = dcache
+        with open(os.path.join(dcache, 'meta.json')) as f:
+            meta = json.load(f)
+        self.keys = meta['keys']
+        self.offsets = {k: np.load(os.path.join(dcache, '{}.idx.npy'.format(k)), mmap_mode='r') for k in self.keys}
+        self.blobs = {}
+        for k in self.keys:
+            fblob = os.path.join(dcache, '{}.bin'.format(k))
+            self.blobs[k] = np.memmap(fblob, dtype=np.uint8, mode='r') if os.path.getsize(fblob) else np.zeros(0, dtype=np.uint8)
+        self.num_examples = meta['num_examples']
+        self.indices = indices
+
+    @classmethod
+    def compile(cls, fdata, proc, dout):
+        """
+        Processes every example of `fdata` with `proc` and writes the columns to `dout`.
+        Concurrent runs compile to their own temporary directories, and the first to finish provides `dout`.
+        """
+        dtmp = '{}.{}.tmp'.format(dout, uuid.uuid4().hex)
+        os.makedirs(dtmp)
+        try:
+            cls.write_columns(fdata, proc, dtmp)
+            try:
+                # only complete caches are ever visible under dout
+                os.replace(dtmp, dout)
+            except OSError:
+                # another run compiled the same cache first
+                if not os.path.isfile(os.path.join(dout, 'meta.json')):
+                    raise
+        finally:
+            if os.path.isdir(dtmp):
+                shutil.rmtree(dtmp)
+
+    @classmethod
+    def write_columns(cls, fdata, proc, dtmp):
+        """
+        Writes the columns, compact examples and metadata of `fdata` to the directory `dtmp`.
+        """
+        keys = None
+        files = {}
+        offsets = defaultdict(lambda: [0])
+        compact = []
+        for ex in tqdm(iter_examples(fdata), desc='compiling {}'.format(os.path.basename(fdata))):
+            processed = proc(ex)
+            if keys is None:
+                keys = sorted(processed.keys())
+                files = {k: open(os.path.join(dtmp, '{}.bin'.format(k)), 'wb') for k in keys}
+            assert sorted(processed.keys()) == keys, 'Processed examples have different fields: {} vs {}'.format(keys, sorted(processed.keys()))
+            for k in keys:
+                cell = pickle.dumps(processed[k], protocol=pickle.HIGHEST_PROTOCOL)
+                files[k].write(cell)
+                offsets[k].append(offsets[k][-1] + len(cell))
+            compact.append(compact_example(ex))
+        for k in keys or []:
+            files[k].close()
+            np.save(os.path.join(dtmp, '{}.idx.npy'.format(k)), np.array(offsets[k], dtype=np.int64))
+        with open(os.path.join(dtmp, 'compact.pkl'), 'wb') as f:
+            pickle.dump(compact, f)
+        with open(os.path.join(dtmp, 'meta.json'), 'wt') as f:
+            json.dump(dict(keys=keys or [], num_examples=len(compact), fdata=os.path.abspath(fdata)), f)
+
+    @classmethod
+    def open_or_compile(cls, fdata, Model, cache_dir):
+        """
+        Opens the compiled cache of `fdata` for `Model`, compiling it first if it does not exist.
+        The cache is keyed by the model name, the model source and the content of `fdata`.
+        """
+        key = '{}-{}-{}'.format(Model.__module__, model_digest(Model)[:12], file_digest(fdata)[:16])
+        dcache = os.path.join(cache_dir, key)
+        if not os.path.isdir(dcache):
+            print('Compiling processed examples to {}'.format(dcache))
+            os.makedirs(cache_dir, exist_ok=True)
+            cls.compile(fdata, Model.process, dcache)
+        return cls(dcache)
+
+    def compact_examples(self):
+        with open(os.path.join(self.dcache, 'compact.pkl'), 'rb') as f:
+            compact = pickle.load(f)
+        if self.indices is None:
+            return compact
+        return [compact[i] for i in self.indices]
+
+    def select(self, single=False, limit=None, seed=0):
+        """
+        Returns a view over a subset of the examples, selected the same way as `train_baselines.MyDataset`.
+        """
+        indices = list(range(self.num_examples))
+        if single:
+            rng = random.Random(seed)
+            by_cluster = defaultdict(list)
+            for i, ex in enumerate(self.compact_examples()):
+                by_cluster[ex['cluster_id']].append(i)
+            cluster_ids = sorted(list(by_cluster.keys()))
+            indices = [rng.choice(by_cluster[c]) for c in cluster_ids]
+        if limit is not None:
+            indices = list(range(self.num_examples))[:limit]
+        return self.__class__(self.dcache, indices=indices)
+
+    def __getitem__(self, index):
+        if self.indices is not None:
+            index = self.indices[index]
+        out = {}
+        for k in self.keys:
+            start, end = self.offsets[k][index], self.offsets[k][index+1]
+            out[k] = pickle.loads(self.blobs[k][start:end].tobytes())
+        return out
+
+    def __len__(self):
+        return self.num_examples if self.indices is None else len(self.indices)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import time
+import json
+import torch
+import argparse
+import omegaconf
+import numpy as np
+from ordered_set import OrderedSet
+from transformers import AutoTokenizer
+from wrangl.learn import SupervisedModel
+from token_cache import pad_ids
+from cpu_inference import ROOT_DIR
+from bucketing import make_buckets
+
+
+class LogitsOnly(torch.nn.Module):
+    """
+    Wraps a sequence classifier so that it maps token ids and attention mask to logits only, which is what tracing needs.
+    """
+
+    def __init__(self, lm):
+        super().__init__()
+        self.lm = lm
+
+    def forward(self, input_ids, attention_mask):
+        return self.lm(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+def export(model, dout, example_contexts):
+    """
+    Traces the classifier of a `binary*` model on CPU and saves it to `dout` with its tokenizer and inference settings, so that `ExportedClassifier` can load it without the model code or the pretrained weights.
+    """
+    os.makedirs(dout, exist_ok=True)
+    model = model.cpu().eval()
+    context = model.encode_text(example_contexts, max_length=model.hparams.max_context_length)
+    with torch.no_grad():
+        traced = torch.jit.trace(LogitsOnly(model.lm), (context['input_ids'], context['attention_mask']))
+        traced = torch.jit.freeze(traced.eval())
+    torch.jit.save(traced, os.path.join(dout, 'model.pt'))
+    model.tokenizer.save_pretrained(dout)
+    with open(os.path.join(dout, 'config.json'), 'wt') as f:
+        json.dump(dict(model=model.hparams.model, max_context_length=model.hparams.max_context_length, infer_max_tokens=model.hparams.get('infer_max_tokens') or 8192), f, indent=2)
+
+
+class ExportedClassifier:
+    """
+    Predicts answers with a classifier saved by `export`.
+    Examples are processed by the classmethods of the original model class, which does not load any weights.
+    """
+
+    def __init__(self, dexport):
+        with open(os.path.join(dexport, 'config.json')) as f:
+            self.config = json.load(f)
+        self.graph = torch.jit.load(os.path.join(dexport, 'model.pt'), map_location='cpu')
+        self.tokenizer = AutoTokenizer.from_pretrained(dexport)
+        self.Model = SupervisedModel.load_model_class(self.config['model'], root_dir=ROOT_DIR)
+
+    def logits(self, contexts):
+        ids = self.tokenizer(contexts, add_special_tokens=True, truncation=True, max_length=self.config['max_context_length'])['input_ids']
+        logits = np.zeros((len(contexts), 2), dtype=np.float32)
+        with torch.no_grad():
+            for b in make_buckets([len(x) for x in ids], max_tokens=self.config['infer_max_tokens'], max_batch_size=None):
+                context = pad_ids(self.tokenizer, [ids[i] for i in b])
+                logits[b] = self.graph(context['input_ids'], context['attention_mask']).numpy()
+        return logits
+
+    def predict(self, examples):
+        """
+        Returns the predicted answers of each raw example, as `binary.Model.extract_pred` does.
+        """
+        candidates = [self.Model.process(ex)['candidates'] for ex in examples]
+        logits = self.logits([c['context'] for cands in candidates for c in cands])
+        preds = []
+        start = 0
+        for cands in candidates:
+            out = logits[start:start+len(cands)].argmax(1)
+            preds.append(OrderedSet([c['text'] for c, o in zip(cands, out) if o]))
+            start += len(cands)
+        return preds
+
+
+def benchmark(dsave, fsave, dexport, examples, batch_size):
+    """
+    Reports the time to load and the per batch latency of the exported classifier and of the checkpoint loaded through the model class.
+    """
+    results = []
+    for method in ['checkpoint', 'exported']:
+        start = time.time()
+        if method == 'checkpoint':
+            cfg = omegaconf.OmegaConf.load(os.path.join(dsave, 'config.yaml'))
+            Model = SupervisedModel.load_model_class(cfg.model, root_dir=ROOT_DIR)
+            model = Model.load_from_checkpoint(os.path.join(dsave, fsave), map_location='cpu').configure_inference(cfg).eval()
+        else:
+            model = ExportedClassifier(dexport)
+        load_time = time.time() - start
+        pred, latency = [], []
+        for i in range(0, len(examples), batch_size):
+            batch = examples[i:i+batch_size]
+            start = time.time()
+            if method == 'checkpoint':
+                with torch.no_grad():
+                    pred.extend(model.predict_step([model.process(ex) for ex in batch], 0))
+            else:
+                pred.extend(model.predict(batch))
+            latency.append(time.time() - start)
+        results.append(dict(method=method, load_sec=load_time, ms_per_batch=1000 * float(np.mean(latency)), pred=pred))
+    same = results[0].pop('pred') == results[1].pop('pred')
+    for r in results:
+        r['same_pred'] = same
+    return results
+
+
+if __name__ == '__main__':
+    from evaluation import iter_examples
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('command', choices=['export', 'predict', 'bench'])
+    parser.add_argument('--dsave', help='save folder of experiment, to export or benchmark against')
+    parser.add_argument('--fsave', default='last.ckpt', help='checkpoint file')
+    parser.add_argument('--dexport', help='exported classifier directory', default='exported')
+    parser.add_argument('--fdata', default='dataset_construction/evidence/closed/top_5.dev.json.bz2', help='data file to predict on')
+    parser.add_argument('--fout', default='pred.dev.json')
+    parser.add_argument('--num_examples', default=100, type=int, help='number of examples to benchmark with')
+    parser.add_argument('--batch_size', default=10, type=int)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        cfg = omegaconf.OmegaConf.load(os.path.join(args.dsave, 'config.yaml'))
+        Model = SupervisedModel.load_model_class(cfg.model, root_dir=ROOT_DIR)
+        assert Model.MyAutoModel.__name__ == 'AutoModelForSequenceClassification', 'Only binary classifiers can be exported'
+        model = Model.load_from_checkpoint(os.path.join(args.dsave, args.fsave), map_location='cpu')
+        example = next(iter_examples(args.fdata))
+        export(model, args.dexport, [c['context'] for c in Model.process(example)['candidates']][:2] * 2)
+        print('exported to {}'.format(args.dexport))
+    elif args.command == 'predict':
+        classifier = ExportedClassifier(args.dexport)
+        examples = list(iter_examples(args.fdata))
+        pred = []
+        for i in range(0, len(examples), args.batch_size):
+            pred.extend(classifier.predict(examples[i:i+args.batch_size]))
+        with open(args.fout, 'wt') as f:
+            json.dump({ex['id']: list(p) for ex, p in zip(examples, pred)}, f)
+    else:
+        examples = [ex for _, ex in zip(range(args.num_examples), iter_examples(args.fdata))]
+        for r in benchmark(args.dsave, args.fsave, args.dexport, examples, args.batch_size):
+            print(r)
@@ -0,0 +1,121 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import atexit
+import sqlite3
+import hashlib
+import logging
+import weakref
+import numpy as np
+from collections import OrderedDict
+from token_cache import text_key
+
+
+logger = logging.getLogger(__name__)
+
+
+def update_digest(h, value):
+    if torch.is_tensor(value):
+        # quantized state holds int8 tensors with their scales, which are hashed through their float values
+        value = value.dequantize() if value.is_quantized else value
+        h.update('{}{}'.format(value.dtype, tuple(value.shape)).encode('utf-8'))
+        h.update(value.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            update_digest(h, v)
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+
+def model_fingerprint(module):
+    """
+    Hashes every value of the state dict of `module`, so that any update to the weights changes the fingerprint.
+    Models compute it once when they first use a cache, and again after training, so the cost of hashing the whole model is paid once per inference run.
+    """
+    h = hashlib.sha1()
+    for name, v in module.state_dict().items():
+        h.update(name.encode('utf-8'))
+        update_digest(h, v)
+    return h.hexdigest()
+
+
+class LogitCache:
+    """
+    Cache of classifier logits keyed by the fingerprint of the weights that produced them and the hash of the input text.
+    Recent logits are kept in a bounded in-memory LRU. If `fcache` is given, all logits are also written to a SQLite file and looked up there on in-memory misses, so they are shared between runs.
+    The statistics of every cache that is still alive are logged at exit.
+    """
+
+    # caches whose statistics are logged at exit
+    instances = weakref.WeakSet()
+
+    def __init__(self, max_size=1000000, fcache=None, name='logit cache'):
+        self.name = name
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        self.db = None
+        if fcache:
+            self.db = sqlite3.connect(fcache)
+            self.db.execute('CREATE TABLE IF NOT EXISTS logits(fingerprint TEXT, key INTEGER, logits BLOB, PRIMARY KEY(fingerprint, key))')
+            self.db.commit()
+        self.instances.add(self)
+
+    @classmethod
+    def db_key(cls, key):
+        # SQLite integers are signed 64 bit
+        return key - (1 << 64) if key >= 1 << 63 else key
+
+    def get(self, fingerprint, texts):
+        """
+        Returns the cached logits of each text, or None for texts that are not cached.
+        """
+        keys = [(fingerprint, text_key(t)) for t in texts]
+        out = [self.cache.get(k) for k in keys]
+        if self.db is not None:
+            missing = list(OrderedDict.fromkeys(k for k, o in zip(keys, out) if o is None))
+            found = {}
+            for start in range(0, len(missing), 500):
+                chunk = [self.db_key(key) for _, key in missing[start:start+500]]
+                rows = self.db.execute('SELECT key, logits FROM logits WHERE fingerprint = ? AND key IN ({})'.format(','.join('?' * len(chunk))), [fingerprint] + chunk)
+                for key, logits in rows:
+                    found[(fingerprint, key % (1 << 64))] = np.frombuffer(logits, dtype=np.float32)
+            for k, v in found.items():
+                self.cache[k] = v
+            out = [found.get(k) if o is None else o for k, o in zip(keys, out)]
+        for k, o in zip(keys, out):
+            if o is not None:
+                self.cache.move_to_end(k)
+        self.hits += sum(o is not None for o in out)
+        self.misses += sum(o is None for o in out)
+        self.evict()
+        return out
+
+    def put(self, fingerprint, texts, logits):
+        rows = []
+        for t, v in zip(texts, logits):
+            k = (fingerprint, text_key(t))
+            self.cache[k] = v = np.asarray(v, dtype=np.float32)
+            rows.append((fingerprint, self.db_key(k[1]), v.tobytes()))
+        if self.db is not None:
+            self.db.executemany('INSERT OR REPLACE INTO logits VALUES (?, ?, ?)', rows)
+            self.db.commit()
+        self.evict()
+
+    def evict(self):
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self.cache), hits=self.hits, misses=self.misses, hit_rate=self.hits / max(1, total))
+
+
+@atexit.register
+def log_stats():
+    for cache in list(LogitCache.instances):
+        logger.info('{} {}'.format(cache.name, cache.stats()))
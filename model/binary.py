@@ -4,16 +4,29 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import re
 import torch
 import numpy as np
+from collections import OrderedDict
 from ordered_set import OrderedSet
 from transformers import AutoModelForSequenceClassification
 from model.seq2seq import Model as Base
+from token_cache import pad_ids
+from bucketing import make_buckets
+from logit_cache import LogitCache, model_fingerprint
+
+
+STOP_WORDS = {'and', 'but', 'not', 'the', 'what', 'which', 'who', 'whom', 'was', 'were', 'has', 'had', 'have', 'for', 'with', 'from', 'that', 'this', 'are', 'its', 'also'}
+
+
+def content_words(text):
+    return {w for w in re.findall(r'\w+', text.lower()) if len(w) > 2 and w not in STOP_WORDS}
 
 
 class Model(Base):
 
     MyAutoModel = AutoModelForSequenceClassification
+    inference_keys = Base.inference_keys + ('infer_max_tokens', 'prefilter_threshold', 'logit_cache_size', 'flogit_cache')
 
     @classmethod
     def process_single(cls, candidate, constraints, caption=None):
@@ -33,25 +46,48 @@ class Model(Base):
         super().__init__(cfg)
         self.rng = np.random.default_rng(cfg.seed)
 
+    def init_inference(self):
+        super().init_inference()
+        self.fingerprint = None
+        self.logit_cache = None
+        if self.hparams.get('logit_cache_size'):
+            self.logit_cache = LogitCache(max_size=self.hparams.logit_cache_size, fcache=self.hparams.get('flogit_cache'))
+
     def build_lm(self):
-        return self.MyAutoModel.from_pretrained(self.hparams.lm, num_labels=2)
+        return self.load_lm(num_labels=2)
+
+    @classmethod
+    def prefilter_score(cls, candidate):
+        """
+        Cheap relevance score of a processed candidate: the fraction of content words of the query that occur in its evidence, that is its context without the query and candidate text.
+        Candidates without evidence all score 0.
+        """
+        query = content_words(candidate['query'])
+        evidence = content_words(candidate['context'].replace(candidate['query'], ' ', 1).replace(candidate['text'], ' ', 1))
+        return len(query & evidence) / max(1, len(query))
 
     def featurize(self, batch):
         context = []
         label = []
         text = []
         ids = []
+        chosen = []
         for i, d in enumerate(batch):
             candidates = d['candidates']
             if self.training:
                 candidates = self.rng.choice(candidates, size=min(len(candidates), self.hparams.sample_size), replace=False).tolist()
+            elif self.hparams.get('prefilter_threshold') is not None:
+                # candidates pruned by the prefilter are predicted negative without running the LM, see prefilter.py
+                candidates = [c for c in candidates if self.prefilter_score(c) >= self.hparams.prefilter_threshold]
             for j, c in enumerate(candidates):
                 ids.append((i, j))
                 text.append(c['text'])
                 context.append(c['context'])
                 label.append(c['label'])
+                chosen.append(c)
         return dict(
             ids=ids,
+            candidates=chosen,
             text=text,
             context_str=context,
             label=torch.tensor(label, dtype=torch.long, device=self.device),
@@ -86,12 +122,46 @@ class Model(Base):
         return out
 
     def infer(self, feat, batch):
-        batch_size = self.hparams.batch_size
-        num_ex = len(feat['context_str'])
-        outputs = []
-        for i in range(0, num_ex, batch_size):
-            feat_i = {k: v[i:i+batch_size] for k, v in feat.items()}
-            batch_i = batch[i:i+batch_size]
-            out_i = self.forward(feat_i, batch_i).logits.max(1)[1].tolist()
-            outputs.extend(out_i)
-        return outputs
+        contexts = feat['context_str']
+        if self.logit_cache is None:
+            logits = self.compute_logits(contexts)
+        else:
+            if self.fingerprint is None:
+                self.fingerprint = model_fingerprint(self.lm)
+            logits = self.logit_cache.get(self.fingerprint, contexts)
+            missing = list(OrderedDict.fromkeys(c for c, l in zip(contexts, logits) if l is None))
+            if missing:
+                computed = dict(zip(missing, self.compute_logits(missing)))
+                self.logit_cache.put(self.fingerprint, missing, [computed[c] for c in missing])
+                logits = [computed[c] if l is None else l for c, l in zip(contexts, logits)]
+        return [int(np.argmax(l)) for l in logits]
+
+    def iter_encoded(self, texts):
+        """
+        Yields the indices of successive inference batches of `texts` and the padded token ids of each batch.
+        With `infer_max_tokens`, texts are batched by token length under a budget of that many padded tokens, instead of in fixed size chunks padded to their longest text.
+        """
+        if not texts:
+            return
+        if self.hparams.get('infer_max_tokens'):
+            ids = self.tokenize(texts, max_length=self.hparams.max_context_length)
+            for b in make_buckets([len(x) for x in ids], max_tokens=self.hparams.infer_max_tokens, max_batch_size=None):
+                yield b, pad_ids(self.tokenizer, [ids[i] for i in b]).to(self.device)
+        else:
+            for i in range(0, len(texts), self.hparams.batch_size):
+                b = list(range(i, min(i + self.hparams.batch_size, len(texts))))
+                yield b, self.encode_text([texts[j] for j in b], max_length=self.hparams.max_context_length).to(self.device)
+
+    def compute_logits(self, contexts):
+        """
+        Runs the classifier on `contexts` and returns the logits as a float32 array, one row per context.
+        """
+        logits = np.zeros((len(contexts), 2), dtype=np.float32)
+        for b, context in self.iter_encoded(contexts):
+            logits[b] = self.lm(context['input_ids'], attention_mask=context['attention_mask']).logits.float().cpu().numpy()
+        return logits
+
+    def train(self, mode=True):
+        # weights may change once training resumes, so the logits cached under the current fingerprint no longer apply
+        self.fingerprint = None
+        return super().train(mode)
@@ -0,0 +1,122 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import numpy as np
+from torch import nn
+from torch.nn import functional as F
+from collections import OrderedDict
+from transformers import AutoModel
+from transformers.modeling_outputs import SequenceClassifierOutput
+from model.binary_dpr import Model as Base
+from logit_cache import LogitCache, model_fingerprint
+
+
+class InteractionHead(nn.Module):
+    """
+    Classifies a pooled candidate encoding against the token encodings of its query: the candidate attends over the query tokens and an MLP scores the pair.
+    """
+
+    def __init__(self, dim, hidden=256):
+        super().__init__()
+        self.attend = nn.Linear(dim, dim)
+        self.mlp = nn.Sequential(nn.Linear(4 * dim, hidden), nn.GELU(), nn.Linear(hidden, 2))
+
+    def forward(self, query_states, query_mask, candidates):
+        """
+        Args:
+            query_states: (n, query_length, dim) token encodings of the query of each candidate.
+            query_mask: (n, query_length) attention mask of the query.
+            candidates: (n, dim) pooled candidate encodings.
+
+        Returns:
+            (n, 2) logits.
+        """
+        scores = torch.einsum('nld,nd->nl', query_states, self.attend(candidates))
+        scores = scores.masked_fill(~query_mask.bool(), float('-inf'))
+        query = torch.einsum('nl,nld->nd', scores.softmax(-1), query_states)
+        return self.mlp(torch.cat([candidates, query, candidates * query, (candidates - query).abs()], dim=-1))
+
+
+class Model(Base):
+    """
+    Late interaction variant of `binary_dpr`.
+    Instead of encoding the query with every candidate, the query is encoded once per example and each candidate with its evidence on its own, and a small head classifies each pair.
+    Candidate encodings do not depend on the question, so at inference they are cached across questions when `candidate_cache_size` is set.
+    """
+
+    MyAutoModel = AutoModel
+    inference_keys = Base.inference_keys + ('candidate_cache_size', )
+
+    @classmethod
+    def process_single(cls, candidate, constraints, caption=None):
+        out = super().process_single(candidate, constraints, caption=caption)
+        out['candidate'] = '{} ; {}'.format(candidate['text'], cls.select_evidence(candidate))
+        return out
+
+    @classmethod
+    def process(cls, ex):
+        out = super().process(ex)
+        out['query'] = cls.construct_query(ex['constraints'])
+        return out
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.head = InteractionHead(self.lm.config.d_model)
+
+    def init_inference(self):
+        super().init_inference()
+        self.candidate_cache = None
+        if self.hparams.get('candidate_cache_size'):
+            self.candidate_cache = LogitCache(max_size=self.hparams.candidate_cache_size, name='candidate cache')
+
+    def build_lm(self):
+        return self.load_lm().get_encoder()
+
+    def pool(self, context):
+        states = self.lm(input_ids=context['input_ids'], attention_mask=context['attention_mask']).last_hidden_state
+        mask = context['attention_mask'].unsqueeze(-1).type_as(states)
+        return (states * mask).sum(1) / mask.sum(1).clamp(min=1)
+
+    def encode_candidates(self, texts):
+        """
+        Returns the pooled encoding of each candidate text.
+        At inference, each distinct text is encoded once per call and looked up in the candidate cache first.
+        """
+        if self.training:
+            return self.pool(self.encode_text(texts, max_length=self.hparams.max_context_length).to(self.device))
+        cached = [None] * len(texts)
+        if self.candidate_cache is not None:
+            if self.fingerprint is None:
+                self.fingerprint = model_fingerprint(self.lm)
+            cached = self.candidate_cache.get(self.fingerprint, texts)
+        missing = list(OrderedDict.fromkeys(t for t, c in zip(texts, cached) if c is None))
+        computed = {}
+        for b, context in self.iter_encoded(missing):
+            for i, v in zip(b, self.pool(context).float().cpu().numpy()):
+                computed[missing[i]] = v
+        if self.candidate_cache is not None and missing:
+            self.candidate_cache.put(self.fingerprint, missing, [computed[t] for t in missing])
+        out = np.zeros((len(texts), self.lm.config.d_model), dtype=np.float32)
+        for i, (t, c) in enumerate(zip(texts, cached)):
+            out[i] = computed[t] if c is None else c
+        return torch.from_numpy(out).to(self.device)
+
+    def score(self, feat, batch):
+        query = self.encode_text([d['query'] for d in batch], max_length=self.hparams.max_context_length).to(self.device)
+        query_states = self.lm(input_ids=query['input_ids'], attention_mask=query['attention_mask']).last_hidden_state
+        candidates = self.encode_candidates([c['candidate'] for c in feat['candidates']])
+        index = torch.tensor([i for i, _ in feat['ids']], dtype=torch.long, device=self.device)
+        return self.head(query_states[index], query['attention_mask'][index], candidates.type_as(query_states))
+
+    def forward(self, feat, batch):
+        logits = self.score(feat, batch)
+        return SequenceClassifierOutput(loss=F.cross_entropy(logits, feat['label']), logits=logits)
+
+    def infer(self, feat, batch):
+        if not feat['ids']:
+            return []
+        return self.score(feat, batch).argmax(1).tolist()
@@ -6,8 +6,10 @@
 
 from ordered_set import OrderedSet
 from wrangl.learn import SupervisedModel
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM as AutoModel
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM as AutoModel
 from wrangl.learn.metrics import SetF1, Accuracy
+from token_cache import TokenCache, pad_ids
+from entity_trie import EntityConstraint, load_entity_names
 
 
 def shift_tokens_right(input_ids, pad_token_id):
@@ -24,6 +26,14 @@ def shift_tokens_right(input_ids, pad_token_id):
 class Model(SupervisedModel):
 
     MyAutoModel = AutoModel
+    # called with each batch of examples and its predictions during inference, see `train_baselines.run_inference`
+    predict_callbacks = ()
+    # inference config applied by `configure_inference` when `run_inference` loads the model from a checkpoint, see `train_baselines.run_inference`
+    inference_cfg = None
+    # config keys that only change inference, which are taken from the inference config instead of the checkpoint
+    inference_keys = ('token_cache_dir', 'constrained_decoding', 'fentities')
+    # whether `load_lm` loads the pretrained weights, which is turned off when every weight is assigned from a checkpoint afterwards, see `cpu_inference.init_worker`
+    pretrained = True
 
     @classmethod
     def construct_query(cls, constraints):
@@ -42,23 +52,61 @@ class Model(SupervisedModel):
             query += ' but not ' + ' and not '.join(no)
         return query
 
+    @classmethod
+    def candidate_names(cls, perm):
+        # canonical names of the candidate entities, which constrained decoding restricts the output to
+        return sorted({c['text'] for c in perm.get('candidates', ())})
+
     @classmethod
     def process(cls, perm):
         query = Model.construct_query(perm['constraints'])
         context = 'what {}?'.format(query)
         label = [a['text'] for a in perm.get('complete_answer', ())]
-        out = dict(context=context, label=set(label), label_str=', '.join(label), id=perm['id'], cluster_id=perm['cluster_id'])
+        out = dict(context=context, label=set(label), label_str=', '.join(label), id=perm['id'], cluster_id=perm['cluster_id'], names=cls.candidate_names(perm))
         return out
 
+    def load_lm(self, **kwargs):
+        if self.pretrained:
+            return self.MyAutoModel.from_pretrained(self.hparams.lm, **kwargs)
+        return self.MyAutoModel.from_config(AutoConfig.from_pretrained(self.hparams.lm, **kwargs))
+
     def build_lm(self):
-        return self.MyAutoModel.from_pretrained(self.hparams.lm)
+        return self.load_lm()
 
     def __init__(self, cfg):
         super().__init__(cfg)
         self.tokenizer = AutoTokenizer.from_pretrained(cfg.lm)
         self.lm = self.build_lm()
+        self.init_inference()
+
+    def init_inference(self):
+        """
+        Sets up the state that depends on the inference keys of the hyperparameters.
+        """
+        if getattr(self, 'token_cache', None) is not None:
+            # the texts tokenized since the last flush would be lost with the replaced cache
+            self.token_cache.flush()
+        self.token_cache = TokenCache(self.hparams.token_cache_dir, self.tokenizer) if self.hparams.get('token_cache_dir') else None
+        self.global_constraint = None
+
+    def configure_inference(self, cfg):
+        """
+        Copies the inference keys of `cfg` onto the hyperparameters, which otherwise come from the checkpoint the model is loaded from.
+        """
+        for k in self.inference_keys:
+            if k in cfg:
+                self.hparams[k] = cfg[k]
+        self.init_inference()
+        return self
+
+    def tokenize(self, texts, max_length):
+        if self.token_cache is not None:
+            return self.token_cache.encode(texts, max_length)
+        return self.tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_length)['input_ids']
 
     def encode_text(self, texts, max_length):
+        if self.token_cache is not None:
+            return pad_ids(self.tokenizer, self.tokenize(texts, max_length))
         return self.tokenizer.batch_encode_plus(
             texts,
             add_special_tokens=True,
@@ -105,15 +153,41 @@ class Model(SupervisedModel):
         out = self.lm(context['input_ids'], attention_mask=context['attention_mask'], decoder_input_ids=decoder_input_ids, labels=feat['label'])
         return out
 
+    def entity_constraint(self, ex):
+        """
+        Returns the constraint of example `ex` for constrained decoding.
+        With `fentities`, as in the open setting, this is every name of the `ents` table of that database, since the candidates of an example would give away the closed setting answer space.
+        Otherwise it is the names of the candidates of the example.
+        """
+        if self.hparams.get('fentities'):
+            if self.global_constraint is None:
+                self.global_constraint = EntityConstraint(self.tokenizer, load_entity_names(self.hparams.fentities))
+            return self.global_constraint
+        return EntityConstraint(self.tokenizer, ex.get('names', ()))
+
     def infer(self, feat, batch):
         context = feat['context']
+        kwargs = dict(max_length=self.hparams.generate.max_pred_label_length)
+        if self.hparams.get('constrained_decoding'):
+            constraints = [self.entity_constraint(ex) for ex in batch]
+            kwargs['prefix_allowed_tokens_fn'] = lambda i, input_ids: constraints[i].allowed_tokens(input_ids)
+            # no output is longer than all the names of its example
+            kwargs['max_length'] = min(kwargs['max_length'], max(c.max_length for c in constraints) + 1)
         generated_ids = self.lm.generate(
             context['input_ids'],
             attention_mask=context['attention_mask'],
             use_cache=True,
             decoder_start_token_id=self.tokenizer.pad_token_id,
             num_beams=self.hparams.generate.num_beams,
-            max_length=self.hparams.generate.max_pred_label_length,
             early_stopping=True,
+            **kwargs,
         )
         return self.tokenizer.batch_decode(generated_ids, clean_up_tokenization_spaces=True, skip_special_tokens=True)
+
+    def on_predict_start(self):
+        if self.inference_cfg is not None:
+            self.configure_inference(self.inference_cfg)
+
+    def on_predict_batch_end(self, outputs, batch, batch_idx, dataloader_idx=0):
+        for callback in self.predict_callbacks:
+            callback(batch, outputs)
@@ -15,5 +15,5 @@ class Model(Base):
         evidence = ' ; '.join([t for t, s in zip(perm['dpr'], perm['dpr_score'])])
         context = 'what {}? {}'.format(query, evidence)
         label = [a['text'] for a in perm.get('complete_answer', ())]
-        out = dict(context=context, label=set(label), label_str=', '.join(label))
+        out = dict(context=context, label=set(label), label_str=', '.join(label), names=cls.candidate_names(perm))
         return out
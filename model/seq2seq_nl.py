@@ -13,5 +13,5 @@ class Model(Base):
     def process(cls, perm, train=True):
         context = '{}'.format(perm['question'])
         label = [a['text'] for a in perm.get('complete_answer', ())]
-        out = dict(context=context, label=set(label), label_str=', '.join(label))
+        out = dict(context=context, label=set(label), label_str=', '.join(label), names=cls.candidate_names(perm))
         return out
@@ -6,12 +6,79 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
-import bz2
+import zlib
 import json as json
 import argparse
 import omegaconf
+from torch.utils.data import Subset
 from wrangl.learn import SupervisedModel
-from train_baselines import MyDataset
+from train_baselines import load_eval_split, run_inference, RunningEvaluation, StreamingDataset
+
+
+def shard_of(ex_id, num_shards):
+    return zlib.crc32(str(ex_id).encode('utf-8')) % num_shards
+
+
+def shard_file(fout, shard_id, num_shards):
+    return '{}.shard{}-of-{}.jsonl'.format(fout, shard_id, num_shards)
+
+
+def load_shard(fshard):
+    """
+    Returns the predictions checkpointed to `fshard` by id.
+    A last line left incomplete by an interrupted run is truncated away so that the file can be appended to.
+    """
+    pred = {}
+    if not os.path.isfile(fshard):
+        return pred
+    with open(fshard, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end < len(content):
+            f.truncate(end)
+    for line in content[:end].decode('utf-8').splitlines():
+        ex = json.loads(line)
+        pred[ex['id']] = ex['pred']
+    return pred
+
+
+class PredictionWriter:
+    """
+    Inference callback that appends the predictions of each batch to a line-delimited checkpoint file.
+    Batches come out of inference in dataset order, so predictions are keyed by the `ids` of the raw examples in that order, since processed examples do not carry an id for every model.
+    """
+
+    def __init__(self, fshard, ids):
+        self.f = open(fshard, 'at')
+        self.ids = ids
+        self.position = 0
+
+    def __call__(self, batch, pred):
+        for p in pred:
+            self.f.write(json.dumps(dict(id=self.ids[self.position], pred=list(p))) + '\n')
+            self.position += 1
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def merge_shards(val, fout, num_shards):
+    """
+    Writes the predictions of all shards to `fout` in the order of `val`, if every shard is complete.
+    """
+    pred = {}
+    for shard_id in range(num_shards):
+        pred.update(load_shard(shard_file(fout, shard_id, num_shards)))
+    missing = [ex['id'] for ex in val if ex['id'] not in pred]
+    if missing:
+        print('Not merging, {} examples are not predicted yet'.format(len(missing)))
+        return False
+    print('Saving to {}'.format(fout))
+    with open(fout + '.tmp', 'wt') as f:
+        json.dump({ex['id']: pred[ex['id']] for ex in val}, f)
+    os.replace(fout + '.tmp', fout)
+    return True
 
 
 def main():
@@ -21,35 +88,54 @@ def main():
     parser.add_argument('--fsave', default='last.ckpt', help='checkpoint file')
     parser.add_argument('--fdata', default='dataset_construction/evidence/closed/top_5.dev.json.bz2', help='data file to predict on')
     parser.add_argument('--fout', default='pred.dev.json')
+    parser.add_argument('--eval_every', default=0, type=int, help='print running metrics every this many examples, for data with answers')
+    parser.add_argument('--num_shards', default=1, type=int, help='number of shards the examples are partitioned into by id')
+    parser.add_argument('--shard_id', default=0, type=int, help='shard to predict on')
+    parser.add_argument('--merge', action='store_true', help='only merge the predictions of completed shards into fout')
+    parser.add_argument('--cpu_workers', default=0, type=int, help='run inference on a pool of this many CPU processes')
+    parser.add_argument('--cpu_threads', default=1, type=int, help='threads per CPU inference process')
+    parser.add_argument('--quantize', action='store_true', help='run inference on CPU with int8 dynamically quantized linear layers')
     args = parser.parse_args()
 
     fconfig = os.path.join(args.dsave, 'config.yaml')
     assert os.path.isfile(fconfig), 'Missing experiment config file at {}'.format(fconfig)
 
     cfg = omegaconf.OmegaConf.load(fconfig)
-    overwrite = {}
-    for kv in args.overwrite:
-        k, v = kv.split('=')
-        overwrite[k] = v
-    cfg.update(overwrite)
+    # values are parsed as YAML, so that numbers and booleans keep their types
+    cfg.merge_with_dotlist(args.overwrite)
+    if args.cpu_workers:
+        cfg.cpu_workers = args.cpu_workers
+        cfg.cpu_threads = args.cpu_threads
+    if args.quantize:
+        cfg.quantize = True
 
     Model = SupervisedModel.load_model_class(cfg.model, root_dir=os.getcwd())
 
     print('Loading data')
-    with bz2.open(args.fdata, 'rt') as f:
-        val = json.load(f)
-
-    dataset_val = MyDataset(val, Model.process)
+    val, dataset_val = load_eval_split(args.fdata, Model, cache_dir=cfg.get('processed_cache_dir'))
     fout = os.path.join(args.dsave, args.fout)
     fsave = os.path.join(args.dsave, args.fsave)
 
-    pred = Model.run_inference(cfg, fsave, dataset_val, test=False)
-    # hack to serialize OrderedSets
-    assert len(pred) == len(val)
-    pred = {ex['id']: list(p) for ex, p in zip(val, pred)}
-    print('Saving to {}'.format(fout))
-    with open(fout, 'wt') as f:
-        json.dump(pred, f)
+    if not args.merge:
+        # predictions are checkpointed as they are produced, and examples already predicted by an earlier run are skipped
+        fshard = shard_file(fout, args.shard_id, args.num_shards)
+        done = load_shard(fshard)
+        todo = [i for i, ex in enumerate(val) if shard_of(ex['id'], args.num_shards) == args.shard_id and ex['id'] not in done]
+        print('Shard {} of {}: {} examples already predicted, predicting {}'.format(args.shard_id, args.num_shards, len(done), len(todo)))
+        if todo:
+            writer = PredictionWriter(fshard, [val[i]['id'] for i in todo])
+            callbacks = [writer]
+            if args.eval_every and all('complete_answer' in ex for ex in val):
+                running = RunningEvaluation([val[i] for i in todo], log_every=args.eval_every)
+                callbacks.append(running)
+            dataset = dataset_val.select(todo) if isinstance(dataset_val, StreamingDataset) else Subset(dataset_val, todo)
+            pred = run_inference(Model, cfg, fsave, dataset, callbacks=callbacks)
+            writer.close()
+            assert len(pred) == len(todo)
+            if len(callbacks) > 1:
+                print('eval results for {}'.format(args.fdata))
+                print(running.evaluator.metrics())
+    merge_shards(val, fout, args.num_shards)
 
 
 if __name__ == '__main__':
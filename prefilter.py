@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import time
+import argparse
+import omegaconf
+import numpy as np
+from wrangl.learn import SupervisedModel
+from evaluation import evaluate, iter_examples, compact_example
+from cpu_inference import ROOT_DIR, predict_batches
+
+
+def calibrate(scores, labels, recall):
+    """
+    Returns the highest threshold that keeps at least a `recall` fraction of the positive candidates.
+    """
+    positive = np.sort(np.asarray(scores)[np.asarray(labels, dtype=bool)])
+    if not len(positive):
+        return 0.
+    return float(positive[int(np.floor((1 - recall) * len(positive)))])
+
+
+def report(scores, labels, lengths, threshold):
+    """
+    Reports the candidate recall of the prefilter at `threshold`, the fraction of candidates it prunes and the resulting reduction of the characters sent to the LM.
+    """
+    scores, labels, lengths = np.asarray(scores), np.asarray(labels, dtype=bool), np.asarray(lengths)
+    keep = scores >= threshold
+    return dict(
+        threshold=threshold,
+        candidate_recall=float(keep[labels].mean()) if labels.any() else 1.,
+        pruned=float(1 - keep.mean()),
+        estimated_speedup=float(lengths.sum() / max(1, lengths[keep].sum())),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', default='binary_dpr', help='binary model variant whose processed candidates are scored, unless --dsave is given, whose model is used instead')
+    parser.add_argument('--fdata', default='dataset_construction/evidence/closed/top_5.dev.json.bz2', help='data file with answers to calibrate on')
+    parser.add_argument('--recall', nargs='+', default=[0.95, 0.98, 0.99, 1.0], type=float, help='target recall of answer candidates')
+    parser.add_argument('--dsave', help='save folder of an experiment, to also measure the speedup and change in metrics of the model')
+    parser.add_argument('--fsave', default='last.ckpt', help='checkpoint file')
+    parser.add_argument('--num_examples', default=None, type=int, help='only use the first examples')
+    args = parser.parse_args()
+
+    cfg = omegaconf.OmegaConf.load(os.path.join(args.dsave, 'config.yaml')) if args.dsave else None
+    # the checkpoint can only be loaded by the model class it was trained with
+    Model = SupervisedModel.load_model_class(cfg.model if cfg is not None else args.model, root_dir=ROOT_DIR)
+    data = [ex for _, ex in zip(range(args.num_examples or int(1e12)), iter_examples(args.fdata))]
+    processed = [Model.process(ex) for ex in data]
+    candidates = [c for ex in processed for c in ex['candidates']]
+    scores = [Model.prefilter_score(c) for c in candidates]
+    labels = [c['label'] for c in candidates]
+    lengths = [len(c['context']) for c in candidates]
+    thresholds = []
+    for recall in args.recall:
+        thresholds.append(calibrate(scores, labels, recall))
+        print(dict(target_recall=recall, **report(scores, labels, lengths, thresholds[-1])))
+
+    if args.dsave:
+        model = Model.load_from_checkpoint(os.path.join(args.dsave, args.fsave), map_location='cpu').configure_inference(cfg).eval()
+        raw = [compact_example(ex) for ex in data]
+        for threshold in [None] + sorted(set(thresholds)):
+            model.hparams.prefilter_threshold = threshold
+            start = time.time()
+            pred = predict_batches(model, processed, cfg.val_batch_size)
+            elapsed = time.time() - start
+            metrics = evaluate(raw, pred)
+            print(dict(threshold=threshold, examples_per_sec=len(raw) / elapsed, f1=metrics['f1'], complete_f1=metrics['complete_f1_@kNone']))
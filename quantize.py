@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+import os
+import time
+import uuid
+import torch
+import argparse
+import omegaconf
+from wrangl.learn import SupervisedModel
+from evaluation import evaluate
+from example_cache import file_digest
+from cpu_inference import ROOT_DIR, iter_batches, predict_batches
+
+
+def quantize_model(model):
+    """
+    Replaces the linear layers of the language model of `model` with int8 dynamically quantized ones, in place.
+    Dynamically quantized layers only run on CPU.
+    """
+    model.lm = torch.ao.quantization.quantize_dynamic(model.lm.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def quantized_file(fcheckpoint):
+    """
+    Returns the file of the quantized weights of `fcheckpoint`, which is named after the digest of the checkpoint so that it is never reused for different weights.
+    """
+    return '{}.{}.int8.pt'.format(os.path.splitext(fcheckpoint)[0], file_digest(fcheckpoint)[:12])
+
+
+def load_quantized(Model, cfg, fcheckpoint):
+    """
+    Loads the int8 quantized model of `fcheckpoint`.
+    The quantized weights are saved next to the checkpoint the first time. Afterwards, the model is built from `cfg` without loading any weights, quantized, and the saved weights are loaded into it, so the checkpoint is neither loaded nor quantized again.
+    """
+    fquantized = quantized_file(fcheckpoint)
+    if os.path.isfile(fquantized):
+        # every weight is loaded from the quantized file, so the pretrained weights are not loaded either, see `cpu_inference.init_worker`
+        Model.pretrained = False
+        try:
+            model = quantize_model(Model(cfg))
+        finally:
+            Model.pretrained = True
+        model.load_state_dict(torch.load(fquantized, map_location='cpu'))
+    else:
+        model = quantize_model(Model.load_from_checkpoint(fcheckpoint, map_location='cpu'))
+        # saved under a temporary name so that other processes never load partial weights
+        ftmp = '{}.{}.tmp'.format(fquantized, uuid.uuid4().hex)
+        torch.save(model.state_dict(), ftmp)
+        os.replace(ftmp, fquantized)
+    return model.configure_inference(cfg).eval()
+
+
+def model_size(model):
+    f = io.BytesIO()
+    torch.save(model.state_dict(), f)
+    return f.tell()
+
+
+def compare(Model, cfg, fcheckpoint, raw, dataset):
+    """
+    Reports the size, throughput and metrics of the fp32 and the int8 quantized model on CPU.
+    """
+    results = []
+    for name in ['fp32', 'int8']:
+        if name == 'fp32':
+            model = Model.load_from_checkpoint(fcheckpoint, map_location='cpu').configure_inference(cfg).eval()
+        else:
+            model = load_quantized(Model, cfg, fcheckpoint)
+        start = time.time()
+        pred = predict_batches(model, dataset, cfg.batch_size)
+        elapsed = time.time() - start
+        metrics = evaluate(raw, pred)
+        results.append(dict(model=name, size_mb=model_size(model) / 2 ** 20, examples_per_sec=len(raw) / elapsed, f1=metrics['f1'], complete_f1=metrics['complete_f1_@kNone']))
+        del model
+    fp32, int8 = results
+    results.append(dict(model='int8 vs fp32', size_ratio=int8['size_mb'] / fp32['size_mb'], speedup=int8['examples_per_sec'] / fp32['examples_per_sec'], f1_change=int8['f1'] - fp32['f1'], complete_f1_change=int8['complete_f1'] - fp32['complete_f1']))
+    return results
+
+
+if __name__ == '__main__':
+    from train_baselines import load_eval_split
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dsave', help='save folder of experiment')
+    parser.add_argument('--fsave', default='last.ckpt', help='checkpoint file')
+    parser.add_argument('--fdata', default='dataset_construction/evidence/closed/top_5.dev.json.bz2', help='data file with answers to compare on')
+    parser.add_argument('--num_examples', default=None, type=int, help='compare on the first examples only')
+    parser.add_argument('--num_threads', default=None, type=int)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    cfg = omegaconf.OmegaConf.load(os.path.join(args.dsave, 'config.yaml'))
+    Model = SupervisedModel.load_model_class(cfg.model, root_dir=ROOT_DIR)
+    raw, dataset = load_eval_split(args.fdata, Model)
+    if args.num_examples:
+        raw = raw[:args.num_examples]
+        dataset = next(iter_batches(dataset, args.num_examples), [])
+    for r in compare(Model, cfg, os.path.join(args.dsave, args.fsave), raw, dataset):
+        print(r)
@@ -6,12 +6,11 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
-import bz2
 import hydra
 import warnings
 import json
 from ordered_set import OrderedSet
-from evaluation import evaluate
+from evaluation import evaluate, iter_examples, compact_example
 
 
 warnings.filterwarnings(
@@ -23,8 +22,7 @@ warnings.filterwarnings(
 def main(cfg):
 
     print('Loading data from {}'.format(cfg.fdata))
-    with bz2.open(cfg.fdata) as f:
-        data = json.load(f)
+    data = [compact_example(ex) for ex in iter_examples(cfg.fdata)]
     data = [ex for ex in data if ex['complete_answer']]
 
     pred = []
@@ -0,0 +1,64 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import sys
+import json
+from ordered_set import OrderedSet
+from wrangl.learn import SupervisedModel
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from predict import PredictionWriter, load_shard, merge_shards, shard_file  # noqa: E402
+
+
+def make_example(i):
+    return dict(
+        id='ex{}'.format(i),
+        cluster_id=i // 2,
+        question='which entity is number {}?'.format(i),
+        constraints=[dict(prop_dir='subj', prop=dict(text='number'), other_ent=dict(text=str(i)), truthy=True)],
+        candidates=[dict(text='a{}'.format(i), is_answer=True), dict(text='b{}'.format(i), is_answer=False)],
+        complete_answer=[dict(text='a{}'.format(i))],
+        dpr=['evidence {}'.format(i)],
+        dpr_score=[1.],
+    )
+
+
+def test_predict_writes_open_setting_predictions(tmp_path):
+    # open setting models process examples without their id
+    Model = SupervisedModel.load_model_class('seq2seq_nl', root_dir=ROOT_DIR)
+    val = [make_example(i) for i in range(5)]
+    todo = [0, 2, 3, 4]
+    batches = [[Model.process(val[i]) for i in todo[:3]], [Model.process(val[i]) for i in todo[3:]]]
+    assert 'id' not in batches[0][0]
+
+    fout = str(tmp_path / 'pred.json')
+    fshard = shard_file(fout, 0, 1)
+    with open(fshard, 'wt') as f:
+        f.write(json.dumps(dict(id='ex1', pred=['a1'])) + '\n')
+    writer = PredictionWriter(fshard, [val[i]['id'] for i in todo])
+    for batch in batches:
+        writer(batch, [OrderedSet([ex['label_str']]) for ex in batch])
+    writer.close()
+
+    assert load_shard(fshard) == {'ex{}'.format(i): ['a{}'.format(i)] for i in range(5)}
+    assert merge_shards(val, fout, 1)
+    with open(fout) as f:
+        assert list(json.load(f).items()) == [('ex{}'.format(i), ['a{}'.format(i)]) for i in range(5)]
+
+
+def test_running_evaluation_matches_by_position():
+    from train_baselines import RunningEvaluation
+    from evaluation import evaluate
+    Model = SupervisedModel.load_model_class('seq2seq_dpr_nl', root_dir=ROOT_DIR)
+    val = [make_example(i) for i in range(5)]
+    pred = [OrderedSet(['a0']), OrderedSet(['b1']), OrderedSet(), OrderedSet(['a3', 'b3']), OrderedSet(['a4'])]
+    running = RunningEvaluation(val, log_every=2)
+    running([Model.process(ex) for ex in val[:2]], pred[:2])
+    running([Model.process(ex) for ex in val[2:]], pred[2:])
+    assert running.evaluator.metrics() == evaluate(val, pred)
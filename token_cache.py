@@ -0,0 +1,204 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import uuid
+import atexit
+import torch
+import hashlib
+import weakref
+import numpy as np
+from transformers import BatchEncoding
+
+
+def text_key(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def tokenizer_key(tokenizer, max_length):
+    name = '{}|{}|{}|{}'.format(type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer), max_length)
+    return '{}-{}'.format(os.path.basename(str(tokenizer.name_or_path).rstrip('/')), hashlib.sha1(name.encode('utf-8')).hexdigest()[:12])
+
+
+def pad_ids(tokenizer, ids):
+    """
+    Pads token ids into the tensors returned by `tokenizer.batch_encode_plus`.
+    """
+    longest = max([len(x) for x in ids], default=0)
+    input_ids = np.full((len(ids), longest), tokenizer.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(ids), longest), dtype=np.int64)
+    for i, x in enumerate(ids):
+        if tokenizer.padding_side == 'left':
+            input_ids[i, longest-len(x):] = x
+            attention_mask[i, longest-len(x):] = 1
+        else:
+            input_ids[i, :len(x)] = x
+            attention_mask[i, :len(x)] = 1
+    return BatchEncoding(dict(input_ids=torch.from_numpy(input_ids), attention_mask=torch.from_numpy(attention_mask)))
+
+
+class TokenShard:
+    """
+    Token ids of a set of texts, stored as ragged int32 arrays: the ids of all texts concatenated, the offset of each text, and the sorted 64 bit hashes of the texts.
+    """
+
+    def __init__(self, keys, offsets, ids, name=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.ids = ids
+        self.name = name
+
+    @classmethod
+    def load(cls, din, name):
+        return cls(*[np.load(os.path.join(din, '{}.{}.npy'.format(name, k)), mmap_mode='r') for k in ['keys', 'offsets', 'ids']], name=name)
+
+    @classmethod
+    def save(cls, dout, keys, offsets, ids):
+        # files are written under a temporary name so that other processes never load a partial shard
+        name = uuid.uuid4().hex
+        for k, v in zip(['keys', 'offsets', 'ids'], [keys, offsets, ids]):
+            np.save(os.path.join(dout, '{}.{}.tmp.npy'.format(name, k)), v)
+        for k in ['ids', 'offsets', 'keys']:
+            os.replace(os.path.join(dout, '{}.{}.tmp.npy'.format(name, k)), os.path.join(dout, '{}.{}.npy'.format(name, k)))
+        return name
+
+    @classmethod
+    def write(cls, dout, entries):
+        keys = np.array(sorted(entries.keys()), dtype=np.uint64)
+        lengths = [len(entries[k]) for k in keys.tolist()]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        ids = np.concatenate([entries[k] for k in keys.tolist()]).astype(np.int32) if len(keys) else np.zeros(0, dtype=np.int32)
+        return cls.save(dout, keys, offsets, ids)
+
+    @classmethod
+    def merge(cls, dout, shards):
+        """
+        Writes the entries of `shards` as a single shard, keeping the first shard's entry of keys that are in several.
+        """
+        bases = np.cumsum([0] + [len(s.ids) for s in shards])
+        starts = np.concatenate([np.asarray(s.offsets[:-1]) + b for s, b in zip(shards, bases)])
+        ends = np.concatenate([np.asarray(s.offsets[1:]) + b for s, b in zip(shards, bases)])
+        keys, first = np.unique(np.concatenate([np.asarray(s.keys) for s in shards]), return_index=True)
+        lengths = ends[first] - starts[first]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        # position of every merged token in the concatenated ids of the shards
+        gather = np.repeat(starts[first] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        ids = np.concatenate([np.asarray(s.ids) for s in shards])[gather].astype(np.int32)
+        return cls.save(dout, keys.astype(np.uint64), offsets, ids)
+
+    def remove(self, din):
+        for k in ['keys', 'offsets', 'ids']:
+            try:
+                os.remove(os.path.join(din, '{}.{}.npy'.format(self.name, k)))
+            except FileNotFoundError:
+                # removed by another process compacting the same cache
+                pass
+
+    def lookup(self, keys):
+        """
+        Returns the position of each key in the shard, or -1 if it is missing.
+        """
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    def __getitem__(self, pos):
+        return np.asarray(self.ids[self.offsets[pos]:self.offsets[pos+1]])
+
+
+class TokenCache:
+    """
+    On-disk cache of the token ids of texts, so that each distinct text is only tokenized once across steps, epochs and runs.
+    The cache of a tokenizer and maximum length is a directory of memory-mapped `TokenShard`s.
+    Newly tokenized texts are kept in memory and written as a new shard every `flush_size` texts and at exit.
+    Once there are more than `max_shards` shards, they are merged into one, so that lookups do not go through a growing number of shards.
+    """
+
+    # caches that are flushed at exit
+    instances = weakref.WeakSet()
+
+    def __init__(self, dcache, tokenizer, flush_size=100000, max_shards=8):
+        self.dcache = dcache
+        self.tokenizer = tokenizer
+        self.flush_size = flush_size
+        self.max_shards = max_shards
+        self.shards = {}
+        self.pending = {}
+        self.instances.add(self)
+
+    def directory(self, max_length):
+        return os.path.join(self.dcache, tokenizer_key(self.tokenizer, max_length))
+
+    def open(self, max_length):
+        if max_length not in self.shards:
+            din = self.directory(max_length)
+            os.makedirs(din, exist_ok=True)
+            names = sorted({f.split('.')[0] for f in os.listdir(din) if f.endswith('.keys.npy') and '.tmp.' not in f})
+            self.shards[max_length] = []
+            for name in names:
+                try:
+                    self.shards[max_length].append(TokenShard.load(din, name))
+                except FileNotFoundError:
+                    # merged into another shard by a concurrent compaction
+                    pass
+            self.pending[max_length] = {}
+            self.compact(max_length)
+        return self.shards[max_length], self.pending[max_length]
+
+    def compact(self, max_length):
+        """
+        Merges the shards of `max_length` into one if there are more than `max_shards`.
+        The merged shard is written before the others are removed, so concurrent readers always find every entry in some shard.
+        """
+        shards = self.shards[max_length]
+        if len(shards) <= self.max_shards:
+            return
+        din = self.directory(max_length)
+        merged = TokenShard.load(din, TokenShard.merge(din, shards))
+        for shard in shards:
+            shard.remove(din)
+        self.shards[max_length] = [merged]
+
+    def encode(self, texts, max_length):
+        """
+        Returns the token ids of each text, with special tokens and truncated to `max_length`, as int32 arrays.
+        """
+        shards, pending = self.open(max_length)
+        keys = np.array([text_key(t) for t in texts], dtype=np.uint64)
+        out = [pending.get(k) for k in keys.tolist()]
+        for shard in shards:
+            missing = [i for i, o in enumerate(out) if o is None]
+            if not missing:
+                break
+            for i, pos in zip(missing, shard.lookup(keys[missing]).tolist()):
+                if pos >= 0:
+                    out[i] = shard[pos]
+        missing = [i for i, o in enumerate(out) if o is None]
+        if missing:
+            tokenized = self.tokenizer([texts[i] for i in missing], add_special_tokens=True, truncation=True, max_length=max_length)['input_ids']
+            for i, ids in zip(missing, tokenized):
+                out[i] = pending[int(keys[i])] = np.array(ids, dtype=np.int32)
+            if len(pending) >= self.flush_size:
+                self.flush()
+        return out
+
+    def flush(self):
+        for max_length, pending in self.pending.items():
+            if pending:
+                din = self.directory(max_length)
+                name = TokenShard.write(din, pending)
+                self.shards[max_length].append(TokenShard.load(din, name))
+                self.pending[max_length] = {}
+                self.compact(max_length)
+
+
+@atexit.register
+def flush_all():
+    for cache in list(TokenCache.instances):
+        cache.flush()
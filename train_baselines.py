@@ -6,17 +6,20 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
-import bz2
 import hydra
 import torch
 import warnings
 import json as json
 import pickle
 import random
-from evaluation import evaluate
+import itertools
+from evaluation import evaluate, open_data, is_jsonl, iter_examples, compact_example, StreamingEvaluator
+from example_cache import CompiledDataset
+from cpu_inference import run_inference_pool, predict_batches
+from quantize import load_quantized
 from collections import defaultdict
 from wrangl.learn import SupervisedModel
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
 
 warnings.filterwarnings(
@@ -50,8 +53,106 @@ class MyDataset(Dataset):
         return len(self.data)
 
 
+class StreamingDataset(IterableDataset):
+    """
+    Lazily decodes and processes the examples of a line-delimited `.jsonl` or `.jsonl.bz2` split, one at a time.
+    With several data loader workers, each worker processes every `num_workers`-th example.
+    """
+
+    def __init__(self, fname, proc, limit=None, indices=None):
+        self.fname = fname
+        self.proc = proc
+        self.limit = limit
+        self.indices = None if indices is None else set(indices)
+        self.num_examples = None if indices is None else len(self.indices)
+
+    def lines(self):
+        with open_data(self.fname) as f:
+            lines = itertools.islice((line for line in f if line.strip()), self.limit)
+            if self.indices is None:
+                yield from lines
+            else:
+                yield from (line for i, line in enumerate(lines) if i in self.indices)
+
+    def select(self, indices):
+        """
+        Returns a dataset over the examples at `indices` only.
+        """
+        return self.__class__(self.fname, self.proc, limit=self.limit, indices=indices)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        for i, line in enumerate(self.lines()):
+            if worker is None or i % worker.num_workers == worker.id:
+                yield self.proc(json.loads(line))
+
+    def __len__(self):
+        if self.num_examples is None:
+            self.num_examples = sum(1 for _ in self.lines())
+        return self.num_examples
+
+
+def load_eval_split(fname, Model, debug=False, cache_dir=None):
+    """
+    Returns the raw examples of a split, for scoring and writing predictions, and the dataset to run the model on.
+    If `cache_dir` is given, the processed examples are compiled there once and memory-mapped.
+    Otherwise, line-delimited splits are streamed instead of held in memory.
+    """
+    proc = Model.process
+    limit = 100 if debug else None
+    if cache_dir:
+        dataset = CompiledDataset.open_or_compile(fname, Model, cache_dir).select(limit=limit)
+        return dataset.compact_examples(), dataset
+    if is_jsonl(fname):
+        raw = [compact_example(ex) for ex in itertools.islice(iter_examples(fname), limit)]
+        return raw, StreamingDataset(fname, proc, limit=limit)
+    data = list(itertools.islice(iter_examples(fname), limit))
+    return data, MyDataset(data, proc)
+
+
+class RunningEvaluation:
+    """
+    Inference callback that feeds predictions to a `StreamingEvaluator` as they are produced and prints the running metrics every `log_every` examples.
+    Batches come out of inference in dataset order, so predictions are matched by position to `raw_dataset`, the raw examples in the order of the dataset inferred on.
+    """
+
+    def __init__(self, raw_dataset, log_every=1000):
+        self.examples = raw_dataset
+        self.evaluator = StreamingEvaluator()
+        self.log_every = log_every
+
+    def __call__(self, batch, pred):
+        before = self.evaluator.num_examples
+        for p in pred:
+            self.evaluator.add(self.examples[self.evaluator.num_examples], p)
+        if self.log_every and before // self.log_every < self.evaluator.num_examples // self.log_every:
+            print('running eval results after {} examples'.format(self.evaluator.num_examples))
+            print(self.evaluator.metrics())
+
+
+def run_inference(Model, cfg, fcheckpoint, dataset, callbacks=()):
+    """
+    Runs `Model.run_inference`, calling each of `callbacks` with every batch of processed examples and its predictions as they are produced.
+    On every path, the inference keys of `cfg` override those of the checkpoint, see `configure_inference` in `model/seq2seq.py`.
+    If `cpu_workers` is set, inference runs on a pool of that many CPU processes instead, see `cpu_inference.run_inference_pool`.
+    If `quantize` is set, inference runs on CPU with int8 quantized linear layers, see `quantize.quantize_model`.
+    """
+    if cfg.get('cpu_workers'):
+        return run_inference_pool(Model, cfg, fcheckpoint, dataset, int(cfg.cpu_workers), num_threads=int(cfg.get('cpu_threads', 1)), callbacks=callbacks)
+    if cfg.get('quantize'):
+        return predict_batches(load_quantized(Model, cfg, fcheckpoint), dataset, cfg.batch_size, callbacks=callbacks)
+    Model.predict_callbacks = tuple(callbacks)
+    Model.inference_cfg = cfg
+    try:
+        return Model.run_inference(cfg, fcheckpoint, dataset, test=False)
+    finally:
+        Model.predict_callbacks = ()
+        Model.inference_cfg = None
+
+
 def evaluate_dataset(raw_dataset, dataset, fname, Model, cfg):
-    pred = Model.run_inference(cfg, cfg.test_resume, dataset, test=False)
+    callbacks = [RunningEvaluation(raw_dataset, log_every=cfg.eval_log_every)] if cfg.get('eval_log_every') else []
+    pred = run_inference(Model, cfg, cfg.test_resume, dataset, callbacks=callbacks)
     res, per_pred, all_per_pred = evaluate(raw_dataset, pred, return_per_pred=True)
 
     eval_split = os.path.splitext(os.path.basename(fname))[0]
@@ -68,7 +169,7 @@ def evaluate_dataset(raw_dataset, dataset, fname, Model, cfg):
 
 
 def predict_dataset(raw_dataset, dataset, fname, Model, cfg):
-    pred = Model.run_inference(cfg, cfg.test_resume, dataset, test=False)
+    pred = run_inference(Model, cfg, cfg.test_resume, dataset)
     pred = {ex['id']: list(p) for ex, p in zip(raw_dataset, pred)}
     with open('{}.pred.json'.format(os.path.basename(fname)), 'wt') as f:
         json.dump(pred, f)
@@ -80,33 +181,27 @@ def main(cfg):
     Model = SupervisedModel.load_model_class(cfg.model)
 
     print('Loading data')
-    with bz2.open(cfg.fval, 'rt') as f:
-        val = json.load(f)
-
-    if cfg.debug:
-        val = val[:100]
-
-    dataset_val = MyDataset(val, Model.process)
+    cache_dir = cfg.get('processed_cache_dir')
+    val, dataset_val = load_eval_split(cfg.fval, Model, debug=cfg.debug, cache_dir=cache_dir)
 
     if not cfg.test_only:
-        with bz2.open(cfg.ftrain, 'rt') as f:
-            train = json.load(f)
+        compiled = CompiledDataset.open_or_compile(cfg.ftrain, Model, cache_dir) if cache_dir else None
         limit = None
         if cfg.limit:
-            num_clusters = len({ex['cluster_id'] for ex in train})
+            num_clusters = len({ex['cluster_id'] for ex in (compiled.compact_examples() if compiled else iter_examples(cfg.ftrain))})
             limit = num_clusters
-        dataset_train = MyDataset(train, Model.process, cfg.single_example_per_cluster, seed=cfg.seed, limit=limit)
+        if compiled:
+            dataset_train = compiled.select(cfg.single_example_per_cluster, limit=limit, seed=cfg.seed)
+        elif is_jsonl(cfg.ftrain) and not cfg.single_example_per_cluster:
+            dataset_train = StreamingDataset(cfg.ftrain, Model.process, limit=limit)
+        else:
+            train = list(iter_examples(cfg.ftrain))
+            dataset_train = MyDataset(train, Model.process, cfg.single_example_per_cluster, seed=cfg.seed, limit=limit)
         Model.run_train_test(cfg, dataset_train, dataset_val)
 
     evaluate_dataset(val, dataset_val, cfg.fval, Model, cfg)
 
-    with bz2.open(cfg.ftest, 'rt') as f: 
-        test = json.load(f)
-
-    if cfg.debug:
-        test = test[:100]
-
-    dataset_test = MyDataset(test, Model.process)
+    test, dataset_test = load_eval_split(cfg.ftest, Model, debug=cfg.debug, cache_dir=cache_dir)
     predict_dataset(test, dataset_test, cfg.ftest, Model, cfg)
 
 